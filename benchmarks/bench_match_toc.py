@@ -0,0 +1,123 @@
+"""
+Benchmark for TOC-to-chapter matching (`PDFToMarkdown.match_toc`).
+
+Builds a synthetic TOC and chapter dictionary (exact titles, punctuation/case noise, typos,
+extra words and repeated generic headings), runs the original full-scan matcher and
+`TocMatcher`, checks the results are identical and reports both timings.
+
+    python -m benchmarks.bench_match_toc --entries 5000
+"""
+import argparse
+import copy
+import difflib
+import random
+import time
+
+from src.code.pdf_to_md import TocMatcher, normalize_text
+
+WORDS = (
+    "servo amplifier parameter setting error alarm reset robot controller teach pendant "
+    "axis motor encoder battery cable connection installation maintenance inspection "
+    "procedure safety precaution specification wiring input output signal brake origin "
+    "position speed torque limit jog operation program variable command network ethernet "
+    "interface display menu function backup restore calibration tool coordinate system"
+).split()
+GENERIC = ["Overview", "Precautions", "Specifications", "Procedure", "Notes"]
+
+
+def legacy_match(toc, chunk_dict):
+    """The original O(TOC x chapters) implementation, kept verbatim as the reference."""
+    def find_best_match(title, candidates, threshold=0.80):
+        norm_title = normalize_text(title)
+        if not candidates:
+            return None
+        substring_matches = [item for item in candidates if norm_title in normalize_text(item[0]) or normalize_text(item[0]) in norm_title]
+        if len(substring_matches) == 1:
+            return substring_matches[0]
+        scores = []
+        for key, val in candidates:
+            score = difflib.SequenceMatcher(None, norm_title, normalize_text(key)).ratio()
+            scores.append((key, val, score))
+        best = max(scores, key=lambda x: x[2])
+        if best[2] >= threshold:
+            return (best[0], best[1])
+        return None
+
+    retries = []
+    for chapter in toc:
+        match = find_best_match(chapter[1], list(chunk_dict.items()), threshold=0.80)
+        if match is not None:
+            chapter.append(match[1])
+            chunk_dict.pop(match[0])
+        else:
+            retries.append(chapter)
+    for chapter in retries:
+        match = find_best_match(chapter[1], list(chunk_dict.items()), threshold=0.70)
+        if match is not None:
+            chapter.append(match[1])
+            chunk_dict.pop(match[0])
+    return toc
+
+
+def typo(text, rng):
+    position = rng.randrange(len(text))
+    return text[:position] + rng.choice("abcdefghijklmnopqrstuvwxyz") + text[position + 1:]
+
+
+def synthetic(entries, seed=0):
+    rng = random.Random(seed)
+    toc, chunk_dict = [], {}
+    for number in range(entries):
+        level = rng.choice([1, 2, 2, 3, 3, 3])
+        if rng.random() < 0.05:
+            title = f"{rng.choice(GENERIC)}"
+        else:
+            title = f"{number // 100}.{number % 100} " + " ".join(rng.sample(WORDS, rng.randint(2, 6))).capitalize()
+        roll = rng.random()
+        if roll < 0.6:
+            key = title
+        elif roll < 0.75:
+            key = title.upper().replace(" ", "  ") + "."
+        elif roll < 0.9:
+            key = typo(title, rng)
+        else:
+            key = title + " " + rng.choice(WORDS)
+        while key in chunk_dict:
+            key += " "
+        toc.append([level, title, number + 1])
+        chunk_dict[key] = f"{key}\ncontent of chapter {number}"
+    order = list(chunk_dict.items())
+    rng.shuffle(order)
+    return toc, dict(order)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark TOC matching")
+    parser.add_argument("--entries", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-legacy", action="store_true", help="only time TocMatcher")
+    args = parser.parse_args()
+
+    toc, chunk_dict = synthetic(args.entries, args.seed)
+
+    new_toc, new_chunks = copy.deepcopy(toc), dict(chunk_dict)
+    start = time.perf_counter()
+    TocMatcher(new_chunks).match(new_toc)
+    new_seconds = time.perf_counter() - start
+    print(f"TocMatcher: {new_seconds:.2f}s for {args.entries} entries, {len(new_chunks)} chapters unmatched")
+    if args.skip_legacy:
+        return
+
+    old_toc, old_chunks = copy.deepcopy(toc), dict(chunk_dict)
+    start = time.perf_counter()
+    legacy_match(old_toc, old_chunks)
+    old_seconds = time.perf_counter() - start
+    print(f"legacy:     {old_seconds:.2f}s for {args.entries} entries, {len(old_chunks)} chapters unmatched")
+
+    assert new_toc == old_toc, "TocMatcher results differ from the legacy matcher"
+    assert list(new_chunks) == list(old_chunks), "unmatched chapters differ from the legacy matcher"
+    print(f"results identical, speedup x{old_seconds / max(new_seconds, 1e-9):.1f}")
+
+
+if __name__ == "__main__":
+    main()
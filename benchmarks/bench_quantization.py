@@ -0,0 +1,182 @@
+"""
+Recall vs latency vs memory for dense vector storage options on an existing collection.
+
+Copies the dense vectors of `--collection` into one temporary collection per variant
+(float32, int8 and binary quantization, on-disk originals, HNSW `m`), waits for indexing,
+then runs the same queries at several `hnsw_ef` values. Recall@k is measured against an exact
+(brute force) search on the float32 copy. Needs a Qdrant server: local mode has no HNSW or
+quantization. RAM is estimated from the collection layout (vectors + quantized copy + HNSW links),
+since Qdrant does not report memory per collection.
+
+    python -m benchmarks.bench_quantization --collection manuals --vector all-mpnet-base-v2
+"""
+import argparse
+import json
+import os
+import random
+import time
+import numpy as np
+from qdrant_client import QdrantClient, models
+
+from benchmarks.common import run_metadata, save_results, summarize
+from src.code.embedding import hnsw_config, quantization_config
+from src.code.search import search_params
+
+VARIANTS = {
+    "float32": {},
+    "float32_m32": {"hnsw_m": 32},
+    "int8": {"quantization": "int8"},
+    "int8_on_disk": {"quantization": "int8", "on_disk": True},
+    "binary": {"quantization": "binary"},
+    "binary_on_disk": {"quantization": "binary", "on_disk": True},
+}
+
+
+def load_vectors(client, collection, vector_name, limit=None):
+    ids, vectors = [], []
+    offset = None
+    while True:
+        points, offset = client.scroll(collection, limit=1000, offset=offset, with_vectors=[vector_name], with_payload=False)
+        for point in points:
+            ids.append(point.id)
+            vectors.append(point.vector[vector_name])
+        if offset is None or (limit and len(ids) >= limit):
+            break
+    return ids, np.asarray(vectors, dtype=np.float32)
+
+
+def load_queries(history_path, count, seed):
+    """Real queries from the search history, most recent first."""
+    if not history_path or not os.path.exists(history_path):
+        return []
+    queries = []
+    with open(history_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                query = json.loads(line).get("query")
+            except json.JSONDecodeError:
+                continue
+            if query and query not in queries:
+                queries.append(query)
+    random.Random(seed).shuffle(queries)
+    return queries[:count]
+
+
+def estimate_ram_mb(count, dim, quantization=None, on_disk=False, hnsw_m=16):
+    vectors = 0 if on_disk else count * dim * 4
+    quantized = {"int8": count * dim, "binary": count * dim / 8}.get(quantization or "", 0)
+    links = count * (hnsw_m or 16) * 2 * 4  # level-0 links dominate: 2m neighbours, 4-byte ids
+    return (vectors + quantized + links) / (1024 * 1024)
+
+
+def wait_indexed(client, collection, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        info = client.get_collection(collection)
+        if info.status == models.CollectionStatus.GREEN:
+            return info
+        time.sleep(1)
+    raise TimeoutError(f"Collection {collection} not indexed after {timeout}s")
+
+
+def create_variant(client, name, ids, vectors, options, upsert_batch_size=256):
+    if client.collection_exists(name):
+        client.delete_collection(name)
+    client.create_collection(
+        collection_name=name,
+        vectors_config=models.VectorParams(
+            size=vectors.shape[1],
+            distance=models.Distance.COSINE,
+            on_disk=options.get("on_disk") or None,
+            hnsw_config=hnsw_config(options.get("hnsw_m"), options.get("hnsw_ef_construct")),
+            quantization_config=quantization_config(options.get("quantization")),
+        ),
+        # index right away so the timings below are HNSW (not brute force) timings
+        optimizers_config=models.OptimizersConfigDiff(indexing_threshold=0),
+    )
+    for start in range(0, len(ids), upsert_batch_size):
+        client.upsert(name, points=models.Batch(
+            ids=ids[start:start + upsert_batch_size],
+            vectors=vectors[start:start + upsert_batch_size].tolist()
+        ), wait=True)
+    return wait_indexed(client, name)
+
+
+def top_ids(client, collection, vectors, limit, params):
+    found, durations = [], []
+    for vector in vectors:
+        start = time.perf_counter()
+        points = client.query_points(collection, query=vector.tolist(), limit=limit, search_params=params).points
+        durations.append(time.perf_counter() - start)
+        found.append([point.id for point in points])
+    return found, durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantization / on-disk / HNSW recall-latency-memory benchmark")
+    parser.add_argument("--collection", required=True, help="Source hybrid collection")
+    parser.add_argument("--vector", default="all-mpnet-base-v2", help="Dense vector name in the source collection")
+    parser.add_argument("--qdrant_url", default="http://localhost:6333")
+    parser.add_argument("--variants", nargs="+", choices=sorted(VARIANTS), default=list(VARIANTS))
+    parser.add_argument("--hnsw_ef", nargs="+", type=int, default=[16, 64, 128])
+    parser.add_argument("--oversampling", type=float, default=2.0, help="Used with rescoring on quantized variants")
+    parser.add_argument("--limit", type=int, default=10, help="k for recall@k")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--history", default="./data/search_history.jsonl", help="Encode real queries from this file")
+    parser.add_argument("--max_points", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="Keep the variant collections")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    client = QdrantClient(args.qdrant_url, timeout=120)
+    ids, vectors = load_vectors(client, args.collection, args.vector, args.max_points)
+    print(f"Loaded {len(ids)} vectors ({vectors.shape[1]}-d) from {args.collection}")
+    queries = load_queries(args.history, args.queries, args.seed)
+    if queries:
+        from src.code.model_setup import setup_model
+        query_vectors = np.asarray(setup_model(args.vector).encode(queries), dtype=np.float32)
+        print(f"Encoded {len(queries)} queries from {args.history}")
+    else:
+        # no history yet: stored vectors with a little noise stand in for queries
+        rng = np.random.default_rng(args.seed)
+        sample = rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)
+        query_vectors = vectors[sample] + rng.normal(0, 0.02, size=(len(sample), vectors.shape[1])).astype(np.float32)
+        print(f"No search history, using {len(sample)} perturbed stored vectors as queries")
+
+    results = {"meta": run_metadata(), "source": {"collection": args.collection, "points": len(ids), "dim": int(vectors.shape[1])}, "variants": {}}
+    truth = None
+    for variant in ["float32"] + [v for v in args.variants if v != "float32"]:
+        options = VARIANTS[variant]
+        name = f"{args.collection}__bench_{variant}"
+        print(f"[{variant}] building {name}")
+        create_variant(client, name, ids, vectors, options)
+        if truth is None:
+            truth, _ = top_ids(client, name, query_vectors, args.limit, search_params(exact=True))
+        runs = {}
+        for hnsw_ef in args.hnsw_ef:
+            quantized = bool(options.get("quantization"))
+            params = search_params(hnsw_ef, rescore=True if quantized else None,
+                                   oversampling=args.oversampling if quantized else None)
+            found, durations = top_ids(client, name, query_vectors, args.limit, params)
+            recall = float(np.mean([len(set(f) & set(t)) / max(1, len(t)) for f, t in zip(found, truth)]))
+            runs[str(hnsw_ef)] = dict(summarize(durations), recall=recall)
+            print(f"[{variant}] hnsw_ef={hnsw_ef}: recall@{args.limit} {recall:.3f}, "
+                  f"p50 {runs[str(hnsw_ef)]['p50_ms']:.2f} ms, p95 {runs[str(hnsw_ef)]['p95_ms']:.2f} ms")
+        results["variants"][variant] = {
+            "options": options,
+            "est_ram_mb": estimate_ram_mb(len(ids), vectors.shape[1], options.get("quantization"),
+                                          options.get("on_disk", False), options.get("hnsw_m")),
+            "hnsw_ef": runs,
+        }
+        if not args.keep:
+            client.delete_collection(name)
+    print(f"\n{'variant':>16} {'est RAM MB':>11}  " + "  ".join(f"ef={ef}: recall/p95ms" for ef in args.hnsw_ef))
+    for variant, data in results["variants"].items():
+        cells = "  ".join(f"{data['hnsw_ef'][str(ef)]['recall']:.3f}/{data['hnsw_ef'][str(ef)]['p95_ms']:.2f}".rjust(len(f"ef={ef}: recall/p95ms")) for ef in args.hnsw_ef)
+        print(f"{variant:>16} {data['est_ram_mb']:11.1f}  {cells}")
+    save_results(args.output or os.path.join("benchmarks", "results", f"quantization_{time.strftime('%Y%m%d-%H%M%S')}.json"), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Parity and speed check of an embedding backend against the PyTorch model.
+
+Encodes the same chunks with `setup_model(backend="torch")` and the candidate backend, then reports
+per-text cosine agreement (mean / 1st percentile / min), encode throughput and the overlap of top-k
+neighbours for a sample of queries, so switching `EMBEDDING_BACKEND` can be checked on real data.
+Exits non-zero when the minimum cosine is below `--min_cosine`.
+
+    python -m benchmarks.check_embedding_parity data/manual_chunked.json --backend onnx-int8
+"""
+import argparse
+import sys
+import time
+import numpy as np
+
+from src.code.model_setup import BACKENDS, embedding_parity, setup_model
+from src.code.rows import load_rows
+
+
+def load_texts(paths, limit):
+    texts = []
+    for path in paths:
+        texts += [row[-1] for row in load_rows(path)]
+    return texts[:limit] if limit else texts
+
+
+def throughput(model, texts, batch_size):
+    model.encode(texts[:batch_size], batch_size=batch_size)  # warm up
+    start = time.perf_counter()
+    vectors = np.asarray(model.encode(texts, batch_size=batch_size), dtype=np.float32)
+    return len(texts) / (time.perf_counter() - start), vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def neighbour_overlap(reference, candidate, queries=100, k=10, seed=0):
+    """Mean overlap of the top-k neighbours of sampled chunks under both embeddings."""
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(reference), size=min(queries, len(reference)), replace=False)
+    k = min(k, len(reference) - 1)
+    overlaps = []
+    for i in sample:
+        ref_top = set(np.argsort(-(reference @ reference[i]))[1:k + 1])
+        cand_top = set(np.argsort(-(candidate @ candidate[i]))[1:k + 1])
+        overlaps.append(len(ref_top & cand_top) / max(1, k))
+    return float(np.mean(overlaps))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare an embedding backend with the PyTorch model")
+    parser.add_argument("content_paths", nargs="+", help="*_chunked.json(l) files")
+    parser.add_argument("--model_name", default="all-mpnet-base-v2")
+    parser.add_argument("--backend", default="onnx-int8", choices=[b for b in BACKENDS if b != "torch"])
+    parser.add_argument("--limit", type=int, default=1000, help="Max chunks to encode")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--min_cosine", type=float, default=0.98)
+    args = parser.parse_args()
+
+    texts = load_texts(args.content_paths, args.limit)
+    reference = setup_model(args.model_name)
+    candidate = setup_model(args.model_name, backend=args.backend)
+    cosine = embedding_parity(reference, candidate, texts, batch_size=args.batch_size)
+    torch_rate, torch_vectors = throughput(reference, texts, args.batch_size)
+    candidate_rate, candidate_vectors = throughput(candidate, texts, args.batch_size)
+    overlap = neighbour_overlap(torch_vectors, candidate_vectors)
+
+    print(f"{len(texts)} chunks, {args.backend} vs torch")
+    print(f"cosine: mean {cosine['mean']:.4f}, p01 {cosine['p01']:.4f}, min {cosine['min']:.4f}")
+    print(f"top-10 neighbour overlap: {overlap:.3f}")
+    print(f"throughput: torch {torch_rate:.1f} texts/s, {args.backend} {candidate_rate:.1f} texts/s ({candidate_rate / torch_rate:.2f}x)")
+    if cosine["min"] < args.min_cosine:
+        print(f"FAIL: minimum cosine {cosine['min']:.4f} < {args.min_cosine}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
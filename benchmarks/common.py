@@ -0,0 +1,95 @@
+"""Timing, percentile, peak-RSS and result-file helpers shared by the benchmarks."""
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+
+def peak_rss_mb():
+    """Peak resident set size in MB of this process or its largest finished child (worker pools)."""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KB on Linux
+
+
+def measure(fn, repeats=5, warmup=1, setup=None):
+    """Calls `fn()` `warmup` + `repeats` times (after `setup()` each time); returns timed durations in seconds."""
+    durations = []
+    for run in range(warmup + repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        if run >= warmup:
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+def summarize(durations, items_per_run=None):
+    """p50/p95/mean latency in ms and, when `items_per_run` is given, throughput in items/s."""
+    values = np.asarray(durations, dtype=np.float64)
+    summary = {
+        "runs": len(values),
+        "p50_ms": float(np.percentile(values, 50) * 1000),
+        "p95_ms": float(np.percentile(values, 95) * 1000),
+        "mean_ms": float(values.mean() * 1000),
+    }
+    if items_per_run:
+        summary["items_per_run"] = items_per_run
+        summary["docs_per_sec"] = float(items_per_run / values.mean())
+    return summary
+
+
+def run_metadata(argv=None):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "argv": argv if argv is not None else sys.argv[1:],
+    }
+
+
+def save_results(path, results):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to {path}")
+
+
+def load_results(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+COMPARED = (("p50_ms", False), ("p95_ms", False), ("docs_per_sec", True), ("peak_rss_mb", False))
+
+def compare(baseline, current, tolerance=0.10):
+    """
+    Prints per-stage changes between two result files; a change worse than `tolerance`
+    (relative) is flagged. Returns the list of regressed (stage, metric) pairs.
+    """
+    regressions = []
+    for stage, metrics in current["stages"].items():
+        base = baseline.get("stages", {}).get(stage)
+        if not base:
+            print(f"{stage}: no baseline")
+            continue
+        for metric, higher_is_better in COMPARED:
+            if metric not in metrics or not base.get(metric):
+                continue
+            change = (metrics[metric] - base[metric]) / base[metric]
+            worse = -change if higher_is_better else change
+            flag = "  REGRESSION" if worse > tolerance else ""
+            print(f"{stage:>14} {metric:>12}: {base[metric]:10.2f} -> {metrics[metric]:10.2f} ({change:+.1%}){flag}")
+            if flag:
+                regressions.append((stage, metric))
+    return regressions
@@ -0,0 +1,41 @@
+"""Generates synthetic service-manual PDFs (with a TOC) for benchmarks."""
+import random
+import pymupdf
+
+WORDS = (
+    "servo amplifier parameter setting error alarm reset robot controller teach pendant axis "
+    "motor encoder battery cable connection installation maintenance inspection procedure safety "
+    "precaution specification wiring input output signal brake origin position speed torque limit"
+).split()
+
+
+def sentence(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 16))).capitalize() + "."
+
+
+def make_pdf(path, chapters=20, pages_per_chapter=3, seed=0):
+    """Writes a PDF with one level-1 heading per chapter plus level-2 sections; returns page count."""
+    rng = random.Random(seed)
+    doc = pymupdf.open()
+    toc = []
+    for chapter in range(1, chapters + 1):
+        for section in range(pages_per_chapter):
+            page = doc.new_page()
+            if section == 0:
+                level, title = 1, f"{chapter} {rng.choice(WORDS).capitalize()} {rng.choice(WORDS)} chapter {chapter}"
+            else:
+                level, title = 2, f"{chapter}.{section} {rng.choice(WORDS).capitalize()} section {chapter} {section}"
+            page.insert_text((72, 80), title, fontsize=18 if level == 1 else 14)
+            body = "\n".join(sentence(rng) for _ in range(12))
+            page.insert_textbox(pymupdf.Rect(72, 110, 540, 760), body, fontsize=10)
+            toc.append([level, title, page.number + 1])
+    doc.set_toc(toc)
+    doc.save(path)
+    page_count = doc.page_count
+    doc.close()
+    return page_count
+
+
+if __name__ == "__main__":
+    import sys
+    print(make_pdf(sys.argv[1] if len(sys.argv) > 1 else "synthetic.pdf"))
@@ -0,0 +1,264 @@
+"""
+Offline throughput/latency benchmarks for the ingestion and query paths.
+
+Stages (each timed in a fresh process, so peak RSS is per stage):
+- pdf:    `PDFToMarkdown.run` on a generated PDF (see `make_pdf.py`)
+- chunk:  `TextChunker.chunk_file` on its content JSON
+- embed:  `EmbeddingUploader.upload_hybrid_embeddings` into local-mode Qdrant
+- search: `Search.search` and `Search.rrf_search` against that collection
+- rag:    `RagEngine.answer` (what `rag()` runs per request) with a stub OpenAI server
+
+No network is used: Qdrant runs in local mode (`QdrantClient(path=...)`), the LLM is
+`stub_openai.StubOpenAIServer`, and Hugging Face models are loaded from the local caches
+(`HF_HUB_OFFLINE=1`, pass `--allow-download` on the first run). Local-mode BM25 needs `fastembed`.
+
+    python -m benchmarks.run_benchmarks --stages pdf chunk embed search rag --output benchmarks/results/base.json
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/base.json
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.common import compare, load_results, measure, peak_rss_mb, run_metadata, save_results, summarize
+
+STAGES = ("pdf", "chunk", "embed", "search", "rag")
+COLLECTION = "benchmark"
+
+
+class Workspace:
+    """Paths of the generated fixtures shared by all stages."""
+    def __init__(self, root):
+        self.root = root
+        self.pdf = os.path.join(root, "manual.pdf")
+        self.content = os.path.join(root, "manual_content.json")
+        self.chunked = os.path.join(root, "manual_chunked.json")
+        self.images = os.path.join(root, "images")
+        self.qdrant = os.path.join(root, "qdrant")
+        self.secrets = os.path.join(root, "secrets.toml")
+        self.history = os.path.join(root, "search_history.jsonl")
+        self.versions = os.path.join(root, "collection_versions.json")
+        self.manifest = os.path.join(root, "manifest.json")
+
+    def qdrant_client(self):
+        from qdrant_client import QdrantClient
+        return QdrantClient(path=self.qdrant)
+
+    def write_secrets(self):
+        with open(self.secrets, "w", encoding="utf-8") as f:
+            f.write('[openai]\nOPENAI_API_KEY = "stub"\n\n[qdrant]\nQDRANT_URL = "local"\n')
+
+    def queries(self, count, seed=0):
+        """Queries made of the first words of random chunks, so both dense and BM25 retrieval hit."""
+        import json
+        with open(self.chunked, "r", encoding="utf-8") as f:
+            texts = [row[-1] for row in json.load(f)]
+        rng = random.Random(seed)
+        return [" ".join(rng.choice(texts).split()[:8]) for _ in range(count)]
+
+
+def uploader(args, workspace):
+    from src.code.embedding import EmbeddingUploader
+    return EmbeddingUploader(model_name=args.model_name, collection_name=COLLECTION,
+                             encode_batch_size=args.encode_batch_size, upsert_batch_size=args.upsert_batch_size,
+                             versions_path=workspace.versions)
+
+
+def prepare(stage, args, workspace):
+    """Creates the inputs `stage` needs (untimed, in its own process)."""
+    from benchmarks.make_pdf import make_pdf
+    if not os.path.exists(workspace.pdf):
+        make_pdf(workspace.pdf, chapters=args.chapters, pages_per_chapter=args.pages_per_chapter, seed=args.seed)
+    if stage == "pdf":
+        return
+    if not os.path.exists(workspace.content):
+        from src.code.pdf_to_md import PDFToMarkdown
+        PDFToMarkdown(workspace.pdf, image_path=workspace.images).run(workers=args.workers)
+    if stage == "chunk":
+        return
+    if not os.path.exists(workspace.chunked):
+        from src.code.chunking import TextChunker
+        TextChunker("sentence-transformers/" + args.model_name).chunk_file(workspace.content, workspace.chunked, workers=args.workers)
+    if stage == "embed":
+        return
+    client = workspace.qdrant_client()
+    try:
+        if not client.collection_exists(COLLECTION):
+            uploader(args, workspace).upload_hybrid_embeddings(workspace.chunked, manifest_path=workspace.manifest, client=client)
+    finally:
+        client.close()
+    workspace.write_secrets()
+
+
+def bench_pdf(args, workspace):
+    from src.code.pdf_to_md import PDFToMarkdown
+    pages = []
+    def run():
+        converter = PDFToMarkdown(workspace.pdf, image_path=workspace.images)
+        converter.run(workers=args.workers)
+        pages.append(converter.doc.page_count - converter.content_first_page)
+    durations = measure(run, repeats=args.repeats, warmup=args.warmup)
+    return {"pdf": summarize(durations, items_per_run=pages[-1])}
+
+
+def bench_chunk(args, workspace):
+    import json
+    from src.code.chunking import TextChunker
+    chunker = TextChunker("sentence-transformers/" + args.model_name)
+    output = os.path.join(workspace.root, "bench_chunked.json")
+    durations = measure(lambda: chunker.chunk_file(workspace.content, output, workers=args.workers),
+                        repeats=args.repeats, warmup=args.warmup)
+    with open(workspace.content, "r", encoding="utf-8") as f:
+        chapters = len(json.load(f))
+    return {"chunk": summarize(durations, items_per_run=chapters)}
+
+
+def bench_embed(args, workspace):
+    import json
+    client = workspace.qdrant_client()
+    embedder = uploader(args, workspace)
+    with open(workspace.chunked, "r", encoding="utf-8") as f:
+        chunks = len(json.load(f))
+    def reset():
+        if client.collection_exists(COLLECTION):
+            client.delete_collection(COLLECTION)
+        if os.path.exists(workspace.manifest):
+            os.remove(workspace.manifest)
+    try:
+        durations = measure(
+            lambda: embedder.upload_hybrid_embeddings(workspace.chunked, manifest_path=workspace.manifest, client=client),
+            repeats=args.repeats, warmup=args.warmup, setup=reset)
+    finally:
+        client.close()
+    return {"embed": summarize(durations, items_per_run=chunks)}
+
+
+def bench_search(args, workspace):
+    from src.code.model_setup import setup_model
+    from src.code.search import Search
+    client = workspace.qdrant_client()
+    searcher = Search(model=setup_model(args.model_name), collection_name=COLLECTION, model_name=args.model_name,
+                      history_storage=workspace.history, secrets_path=workspace.secrets, client=client)
+    queries = workspace.queries(args.queries, seed=args.seed)
+    results = {}
+    try:
+        for name, method in (("search", searcher.search), ("rrf_search", searcher.rrf_search)):
+            method(queries[0])  # warm up
+            durations = []
+            for query in queries:
+                durations += measure(lambda: method(query), repeats=1, warmup=0)
+            results[name] = summarize(durations)
+    finally:
+        client.close()
+    return results
+
+
+def bench_rag(args, workspace):
+    from benchmarks.stub_openai import StubOpenAIServer
+    client = workspace.qdrant_client()
+    queries = workspace.queries(args.rag_queries, seed=args.seed + 1)
+    with StubOpenAIServer(latency=args.llm_latency) as server:
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        from src.code.rag_workflow import RagEngine
+        engine = RagEngine(workspace.secrets, COLLECTION, model_name=args.model_name, history_storage=workspace.history,
+                           embedding_cache_dir=None, answer_cache=False, llm_cache_path=None, qdrant_client=client)
+        try:
+            engine.warmup().answer(queries[0])
+            durations = []
+            for query in queries:
+                durations += measure(lambda: engine.answer(query), repeats=1, warmup=0)
+        finally:
+            client.close()
+        result = summarize(durations)
+        result["llm_requests"] = server.requests
+        result["llm_latency_ms"] = args.llm_latency * 1000
+    return {"rag": result}
+
+
+BENCHMARKS = {"pdf": bench_pdf, "chunk": bench_chunk, "embed": bench_embed, "search": bench_search, "rag": bench_rag}
+
+
+def _child(target, stage, args, root, queue):
+    try:
+        result = target(stage, args, Workspace(root))
+        queue.put(("ok", result, peak_rss_mb()))
+    except BaseException as e:
+        queue.put(("error", f"{e.__class__.__name__}: {e}", peak_rss_mb()))
+        raise
+
+
+def _prepare(stage, args, workspace):
+    return prepare(stage, args, workspace)
+
+def _bench(stage, args, workspace):
+    return BENCHMARKS[stage](args, workspace)
+
+
+def in_subprocess(target, stage, args, root):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_child, args=(target, stage, args, root, queue))
+    process.start()
+    status, result, rss = queue.get()
+    process.join()
+    if status != "ok":
+        raise RuntimeError(f"{stage}: {result}")
+    return result, rss
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline ingestion/query benchmarks")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--output", help="Results JSON (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Relative change flagged as a regression")
+    parser.add_argument("--workdir", help="Fixture directory, reused across runs (default: a temporary one)")
+    parser.add_argument("--model_name", default="all-mpnet-base-v2")
+    parser.add_argument("--chapters", type=int, default=20)
+    parser.add_argument("--pages_per_chapter", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--encode_batch_size", type=int, default=32)
+    parser.add_argument("--upsert_batch_size", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--rag_queries", type=int, default=10)
+    parser.add_argument("--llm_latency", type=float, default=0.0, help="Stub LLM response delay in seconds")
+    parser.add_argument("--allow-download", action="store_true", help="Allow fetching models from the Hugging Face Hub")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.allow_download:
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    results = {"meta": run_metadata(argv), "stages": {}}
+    with tempfile.TemporaryDirectory(prefix="rag-bench-") as tmp:
+        root = args.workdir or tmp
+        os.makedirs(root, exist_ok=True)
+        for stage in STAGES:
+            if stage not in args.stages:
+                continue
+            print(f"[{stage}] preparing inputs")
+            in_subprocess(_prepare, stage, args, root)
+            print(f"[{stage}] running")
+            metrics, rss = in_subprocess(_bench, stage, args, root)
+            for name, values in metrics.items():
+                values["peak_rss_mb"] = rss
+                results["stages"][name] = values
+                extra = f", {values['docs_per_sec']:.1f} docs/s" if "docs_per_sec" in values else ""
+                print(f"[{name}] p50 {values['p50_ms']:.1f} ms, p95 {values['p95_ms']:.1f} ms{extra}, peak RSS {rss:.0f} MB")
+    output = args.output or os.path.join("benchmarks", "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    save_results(output, results)
+    if args.compare:
+        regressions = compare(load_results(args.compare), results, tolerance=args.tolerance)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+Minimal OpenAI-compatible chat completions server for offline benchmarks and tests.
+
+Serves POST /v1/chat/completions (plain and `stream=True` SSE) with canned answers and a
+configurable latency. Query-refinement prompts get one rewrite per line.
+
+    with StubOpenAIServer(latency=0.2) as server:
+        client = OpenAI(base_url=server.base_url, api_key="stub")
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = "According to the manual, reset the alarm from the teach pendant after removing its cause."
+
+
+def stub_reply(prompt):
+    if "reformulations" in prompt:
+        return "How do I clear this alarm?\nWhat is the reset procedure for this error?"
+    return ANSWER
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        prompt = "\n".join(str(message.get("content", "")) for message in request.get("messages", []))
+        content = stub_reply(prompt)
+        model = request.get("model", "stub")
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+        if request.get("stream"):
+            self._stream(content, model)
+            return
+        body = json.dumps({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4,
+                      "total_tokens": (len(prompt) + len(content)) // 4},
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, content, model):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        tokens = [word + " " for word in content.split(" ")]
+        for index, token in enumerate(tokens + [None]):
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "delta": {"content": token} if token is not None else {},
+                    "finish_reason": None if token is not None else "stop",
+                }],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            if token is not None:
+                time.sleep(self.server.token_latency)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class StubOpenAIServer:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, token_latency=0.0):
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.token_latency = token_latency
+        self.httpd.requests = 0
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the stub OpenAI-compatible server")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    with StubOpenAIServer(port=args.port, latency=args.latency) as server:
+        print(f"Stub OpenAI server on {server.base_url}")
+        server.thread.join()
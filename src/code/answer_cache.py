@@ -0,0 +1,157 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_VERSIONS_PATH = "./data/collection_versions.json"
+
+def read_collection_versions(path=DEFAULT_VERSIONS_PATH):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def bump_collection_version(collection, path=DEFAULT_VERSIONS_PATH):
+    """Marks a collection as re-ingested; answer caches watching `path` drop its entries."""
+    versions = read_collection_versions(path)
+    versions[collection] = versions.get(collection, 0) + 1
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(versions, f, indent=2)
+    os.replace(tmp_path, path)
+    return versions[collection]
+
+def query_codes(query):
+    """Tokens containing digits (error codes, part numbers); these must match exactly for a hit."""
+    return frozenset(token for token in re.findall(r"\w+", query.lower()) if any(ch.isdigit() for ch in token))
+
+
+class SemanticCache:
+    """
+    Answer cache keyed by query embedding, scoped per collection.
+
+    A lookup hits when the cosine similarity to a cached query is >= `threshold` and both queries
+    mention the same codes/numbers (so "reset E5" never answers "reset E6"). Entries expire after
+    `ttl_seconds`, the least recently used ones are evicted above `max_entries` per collection, and
+    all entries of a collection are dropped when its version in `versions_path` changes
+    (see `bump_collection_version`, called after ingestion).
+    """
+    def __init__(self, threshold=0.95, ttl_seconds=3600, max_entries=1000, versions_path=DEFAULT_VERSIONS_PATH):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.versions_path = versions_path
+        self._entries = {}  # collection -> OrderedDict[id -> entry]
+        self._matrices = {}  # collection -> (ids, normalized embedding matrix)
+        self._versions = {}
+        self._versions_mtime = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_versions(self):
+        try:
+            mtime = os.stat(self.versions_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._versions_mtime:
+            return
+        self._versions_mtime = mtime
+        versions = read_collection_versions(self.versions_path)
+        for collection in list(self._entries):
+            if versions.get(collection) != self._versions.get(collection):
+                self._drop(collection)
+        self._versions = versions
+
+    def _drop(self, collection):
+        self._entries.pop(collection, None)
+        self._matrices.pop(collection, None)
+
+    def invalidate(self, collection=None):
+        with self._lock:
+            for name in ([collection] if collection else list(self._entries)):
+                self._drop(name)
+
+    def _expire(self, collection, now):
+        entries = self._entries.get(collection)
+        if not entries:
+            return
+        expired = [key for key, entry in entries.items() if now - entry["created"] > self.ttl_seconds]
+        for key in expired:
+            del entries[key]
+        if expired:
+            self._matrices.pop(collection, None)
+
+    def _matrix(self, collection):
+        if collection not in self._matrices:
+            entries = self._entries.get(collection, {})
+            ids = list(entries)
+            matrix = np.vstack([entries[key]["embedding"] for key in ids]) if ids else None
+            self._matrices[collection] = (ids, matrix)
+        return self._matrices[collection]
+
+    def lookup(self, collection, query, embedding):
+        """Returns the cached entry (dict with answer, search_results, query, similarity) or None."""
+        with self._lock:
+            self.lookups += 1
+            now = time.time()
+            self._check_versions()
+            self._expire(collection, now)
+            ids, matrix = self._matrix(collection)
+            if matrix is None:
+                return None
+            similarities = matrix @ self._normalize(embedding)
+            codes = query_codes(query)
+            for position in np.argsort(-similarities):
+                if similarities[position] < self.threshold:
+                    break
+                entry = self._entries[collection][ids[position]]
+                if entry["codes"] != codes:
+                    continue
+                self._entries[collection].move_to_end(ids[position])
+                self.hits += 1
+                self.saved_seconds += entry["latency"]
+                return dict(entry, similarity=float(similarities[position]))
+            return None
+
+    def store(self, collection, query, embedding, answer, search_results=None, latency=0.0):
+        with self._lock:
+            self._check_versions()
+            entries = self._entries.setdefault(collection, OrderedDict())
+            entries[self._next_id] = {
+                "query": query,
+                "codes": query_codes(query),
+                "embedding": self._normalize(embedding),
+                "answer": answer,
+                "search_results": search_results,
+                "latency": latency,
+                "created": time.time(),
+            }
+            self._next_id += 1
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._matrices.pop(collection, None)
+
+    def stats(self):
+        return {
+            "entries": sum(len(entries) for entries in self._entries.values()),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "saved_seconds": self.saved_seconds,
+        }
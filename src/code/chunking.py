@@ -1,25 +1,65 @@
 import math
 import re
-import json
-import pathlib
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from transformers import AutoTokenizer
+from src.code.rows import load_rows, write_rows
+
+# str.splitlines() boundaries that BERT-style normalizers drop instead of treating as whitespace;
+# a token can then span two "lines", so such texts are counted line by line.
+_NON_WHITESPACE_LINE_BREAKS = "\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+
+_worker_chunker = None
+
+def _init_worker(model_name):
+    """Process-pool initializer: loads the tokenizer once per worker."""
+    global _worker_chunker
+    _worker_chunker = TextChunker(model_name)
+
+def _chunk_chapter(args):
+    text, token_limit = args
+    chunks, _ = _worker_chunker.chunk_text_by_lines(text, token_limit)
+    return chunks
 
 class TextChunker:
     def __init__(self, model_name):
+        self.model_name = model_name
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
 
+    def line_token_counts(self, text, lines):
+        """
+        Token count of the whole text and of every line, from a single tokenizer call.
+        Fast tokenizers map each token to its line through the offset mapping (tokens never
+        cross a newline for whitespace pre-tokenized models); otherwise lines are encoded
+        in one batched call.
+        """
+        single_pass = getattr(self.tokenizer, "is_fast", False) and not any(ch in text for ch in _NON_WHITESPACE_LINE_BREAKS)
+        if single_pass:
+            encoding = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+            line_starts, position = [], 0
+            for line in lines:
+                line_starts.append(position)
+                position += len(line)
+            counts = [0] * len(lines)
+            for start, _ in encoding["offset_mapping"]:
+                counts[bisect_right(line_starts, start) - 1] += 1
+            return len(encoding["offset_mapping"]), counts
+        total = len(self.tokenizer.encode(text, add_special_tokens=False))
+        if not lines:
+            return total, []
+        return total, [len(ids) for ids in self.tokenizer(lines, add_special_tokens=False)["input_ids"]]
+
     def chunk_text_by_lines(self, text, token_limit):
         lines = text.splitlines(keepends=True)
         chunks, current_chunk, current_tokens = [], [], 0
-        all_tokens = self.tokenizer.encode(text, add_special_tokens=False)
-        chunk_size = math.ceil(len(all_tokens) / math.ceil(len(all_tokens)/ token_limit))
-        for line in lines:
-            line_tokens = self.tokenizer.encode(line, add_special_tokens=False)
-            if current_tokens + len(line_tokens) > token_limit:
+        total_tokens, line_counts = self.line_token_counts(text, lines)
+        chunk_size = math.ceil(total_tokens / math.ceil(total_tokens/ token_limit))
+        for line, line_tokens in zip(lines, line_counts):
+            if current_tokens + line_tokens > token_limit:
                 chunks.append("".join(current_chunk).strip())
                 current_chunk, current_tokens = [], 0
             current_chunk.append(line)
-            current_tokens += len(line_tokens)
+            current_tokens += line_tokens
             if current_tokens > chunk_size:
                 chunks.append("".join(current_chunk).strip())
                 current_chunk, current_tokens = [], 0
@@ -38,10 +78,15 @@ class TextChunker:
 
         return text
 
-    def chunk_file(self, input_path, output_path, token_limit=300):
-        json_read = pathlib.Path(input_path).read_text()
-        data = json.loads(json_read)
-        chunked_data = []
+    def chunk_file(self, input_path, output_path, token_limit=300, workers=1, row_format=None):
+        """
+        Chunks every chapter of `input_path` into `[level, title, page, text]` rows.
+        With workers > 1 chapters are chunked in a process pool (one tokenizer per worker);
+        rows keep the chapter order either way. Input and output can be JSON or JSONL row
+        files (`rows.py`); `row_format` defaults to the output extension.
+        """
+        data = load_rows(input_path)
+        chapters, texts = [], []
         for chunk in data:
             try:
                 assert len(chunk) == 4, f"Expected 4 elements per chunk, got {len(chunk)} in chapter {chunk[1]}"
@@ -49,7 +94,21 @@ class TextChunker:
             except AssertionError as e:
                 print(f"Skipping chunk due to error:\n{e}")
                 continue
-            chunks, size = self.chunk_text_by_lines(text, token_limit)
+            chapters.append(chunk)
+            texts.append(text)
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.model_name,)) as executor:
+                chapter_chunks = list(executor.map(
+                    _chunk_chapter,
+                    [(text, token_limit) for text in texts],
+                    chunksize=max(1, len(texts) // (workers * 8))
+                ))
+        else:
+            chapter_chunks = [self.chunk_text_by_lines(text, token_limit)[0] for text in texts]
+
+        chunked_data = []
+        for chunk, chunks in zip(chapters, chapter_chunks):
             for text_chunk in chunks:
                 chunked_data.append([
                     chunk[0],
@@ -57,6 +116,15 @@ class TextChunker:
                     chunk[2],
                     text_chunk
                 ])
-        with open(output_path, mode='w+') as f_out:
-            f_out.write(json.dumps(chunked_data, indent=2))
+        write_rows(output_path, chunked_data, row_format)
         return chunked_data
+
+    def iter_chunks(self, chapters, token_limit=300):
+        """Streaming counterpart of `chunk_file`: yields `[level, title, page, text]` rows chapter by chapter."""
+        for chapter in chapters:
+            if len(chapter) != 4:
+                print(f"Skipping chunk due to error:\nExpected 4 elements per chunk, got {len(chapter)} in chapter {chapter[1]}")
+                continue
+            chunks, _ = self.chunk_text_by_lines(self.clean_text(chapter[-1]), token_limit)
+            for text_chunk in chunks:
+                yield [chapter[0], chapter[1], chapter[2], text_chunk]
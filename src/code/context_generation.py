@@ -2,22 +2,80 @@ import json
 import time
 import toml
 import os
-from pathlib import Path
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from code.prompts import PromptLoader
+from code.rows import load_rows
+
+class RateLimiter:
+    """
+    Token bucket limiting requests and (estimated) tokens per minute across threads.
+    `acquire` blocks until both buckets can cover the request.
+    """
+    def __init__(self, requests_per_minute=60, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute or 0)
+        self._tokens = float(tokens_per_minute or 0)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens=0):
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                self._refill()
+                wait = 0.0
+                if self.requests_per_minute and self._requests < 1:
+                    wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+                if wait == 0.0:
+                    if self.requests_per_minute:
+                        self._requests -= 1
+                    if self.tokens_per_minute:
+                        self._tokens -= tokens
+                    return
+            time.sleep(wait)
+
+
+def _is_retryable(error):
+    status = getattr(error, "status_code", None)
+    return status == 429 or (status is not None and status >= 500) or type(error).__name__ in ("RateLimitError", "APIConnectionError", "APITimeoutError")
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
 
 class ContextGenerator:
-    def __init__(self, prompt_path="data/prompts.yaml"):
+    def __init__(self, prompt_path="data/prompts.yaml", llm_cache=None):
         self.loader = PromptLoader(prompt_path)
+        self.llm_cache = llm_cache
 
-    def generate_context(self, input_path, output_path, llm_client, window_size=3, model='gpt-4.1-mini'):
-        data = json.loads(Path(input_path).read_text())
-        context_dict = dict()
+    def build_prompts(self, data, window_size=3, skip=()):
+        """Yields (index, prompt) for every chunk that needs a context, skipping indices in `skip`."""
         root_chapter_ix = 0
         for index, chunk in enumerate(data):
-            if index in context_dict.keys():
-                continue
             if chunk[0] == 1:
                 root_chapter_ix = index
+            if index in skip:
+                continue
             if 3*len(chunk[1]) > len(chunk[-1]):
                 continue
             paragraph_start = max(root_chapter_ix, index - window_size)
@@ -29,12 +87,79 @@ class ContextGenerator:
                 chunk=chunk[-1],
                 neighbors=paragraphs
             )
-            time.sleep(2)
-            response = llm_client.chat.completions.create(
-                model=model,
-                messages=[{'role': 'user', 'content': prompt }]
-            )
-            context_dict[index] = response.choices[0].message.content
+            yield index, prompt
+
+    def _complete(self, llm_client, model, prompt, limiter, max_retries):
+        if self.llm_cache is not None:
+            cached = self.llm_cache.get(self.llm_cache.key(model, prompt))
+            if cached is not None:
+                return cached  # no request, no rate limit budget used
+        for attempt in range(max_retries + 1):
+            limiter.acquire(tokens=len(prompt) // 4)
+            try:
+                if self.llm_cache is not None:
+                    return self.llm_cache.complete(llm_client, prompt, model, refresh=True)
+                response = llm_client.chat.completions.create(
+                    model=model,
+                    messages=[{'role': 'user', 'content': prompt }]
+                )
+                return response.choices[0].message.content
+            except Exception as e:
+                if attempt == max_retries or not _is_retryable(e):
+                    raise
+                delay = _retry_after(e) or min(60.0, 2 ** attempt) * (0.5 + random.random())
+                print(f"LLM call failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def generate_context(self, input_path, output_path, llm_client, window_size=3, model='gpt-4.1-mini',
+                         max_workers=4, requests_per_minute=30, tokens_per_minute=None, max_retries=5,
+                         checkpoint_path=None):
+        """
+        Generates context for every chunk concurrently, within the configured rate limits.
+        Each finished chunk is appended to a JSONL checkpoint, so a rerun only processes
+        indices that are missing. `llm_client` is any OpenAI-compatible client, e.g.
+        `OpenAI(base_url="http://localhost:8000/v1", api_key="test")` for a local fake server.
+        `input_path` can be a `_chunked.json` or `_chunked.jsonl` row file.
+        """
+        data = load_rows(input_path)
+        checkpoint_path = checkpoint_path or os.path.splitext(output_path)[0] + "_checkpoint.jsonl"
+        context_dict = dict()
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # partially written last line of an interrupted run
+                    context_dict[record["index"]] = record["context"]
+            print(f"Resuming from {checkpoint_path}: {len(context_dict)} chunks already done")
+
+        limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        failures = []
+        tasks = list(self.build_prompts(data, window_size, skip=context_dict.keys()))
+        with open(checkpoint_path, 'a', encoding='utf-8') as checkpoint, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self._complete, llm_client, model, prompt, limiter, max_retries): index
+                for index, prompt in tasks
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                index = futures[future]
+                try:
+                    context = future.result()
+                except Exception as e:
+                    # keep checkpointing the other chunks; a rerun retries the failed ones
+                    print(f"Context generation failed for chunk {index}: {e}")
+                    failures.append(index)
+                    continue
+                checkpoint.write(json.dumps({"index": index, "context": context}) + "\n")
+                checkpoint.flush()
+                context_dict[index] = context
+                if done % 50 == 0 or done == len(futures):
+                    print(f"Generated context for {done}/{len(futures)} chunks")
+
+        if failures:
+            raise RuntimeError(f"Context generation failed for {len(failures)} chunks, rerun to resume: {sorted(failures)}")
+        context_dict = dict(sorted(context_dict.items()))
         with open(output_path, mode='w+') as f_out:
             f_out.write(json.dumps(context_dict, indent=2))
         return context_dict
@@ -1,16 +1,93 @@
 import os
-import pathlib
 import json
-from sentence_transformers import SentenceTransformer
+import hashlib
+import itertools
+import queue
+import threading
+import time
+import uuid
 from qdrant_client import QdrantClient, models
+from src.code.embedding_cache import shared_cache
+from src.code.model_setup import model_cache_key, setup_model
+from src.code.answer_cache import DEFAULT_VERSIONS_PATH, bump_collection_version
+from src.code.rows import load_rows, sibling
+
+# Namespace for deterministic point ids; changing it re-keys every collection.
+POINT_ID_NAMESPACE = uuid.UUID("8b3f6f0e-3f1c-4b8e-9a55-2f0c1f6f8a10")
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def point_id(source: str, chapter: str, text: str, occurrence: int = 0) -> str:
+    """
+    Deterministic point id from the manual's source (see `manual_source`) + chapter + chunk
+    content hash. `occurrence` separates identical chunks repeated within the same chapter.
+    """
+    key = "\x1f".join([source, chapter, content_hash(text), str(occurrence)])
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, key))
+
+def manual_source(path) -> str:
+    """
+    Stable identity of a manual within a collection: the file stem shared by `x.pdf`,
+    `x_content.json(l)` and `x_chunked.json(l)`. PDF titles are often empty or shared,
+    so they are only stored as the `manual` payload.
+    """
+    path = str(path)
+    if path.lower().endswith(".pdf"):
+        path = path[:-len(".pdf")]
+    return os.path.basename(sibling(path, ""))
+
+def manual_title(meta) -> str:
+    """Display title from PDF metadata; a missing or empty title becomes 'Unknown Manual'."""
+    return (meta or {}).get('title') or 'Unknown Manual'
+
+def iter_point_entries(rows, source):
+    """Yields (point_id, root_chapter, chapter) for `[level, title, page, text]` rows, in order."""
+    occurrences = {}
+    root_chapter = ""
+    for chapter in rows:
+        if chapter[0] == 1:
+            root_chapter = chapter[1]
+        pid = point_id(source, chapter[1], chapter[-1])
+        occurrence = occurrences.get(pid, 0)
+        occurrences[pid] = occurrence + 1
+        if occurrence:
+            pid = point_id(source, chapter[1], chapter[-1], occurrence)
+        yield pid, root_chapter, chapter
+
+def quantization_config(quantization, always_ram=True, quantile=0.99):
+    """
+    Qdrant quantization config for "int8" (scalar, 4x smaller) or "binary" (32x smaller,
+    needs rescoring/oversampling at search time); None/"" disables quantization.
+    """
+    if not quantization or quantization == "none":
+        return None
+    if quantization == "int8":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=quantile, always_ram=always_ram)
+        )
+    if quantization == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=always_ram))
+    raise ValueError(f"Unknown quantization '{quantization}', expected 'int8', 'binary' or None")
+
+def hnsw_config(m=None, ef_construct=None):
+    if m is None and ef_construct is None:
+        return None
+    return models.HnswConfigDiff(m=m, ef_construct=ef_construct)
 
 class EmbeddingUploader:
-    def __init__(self, model_name, collection_name, cache_folder="./models"):
+    def __init__(self, model_name, collection_name, cache_folder="./models", encode_batch_size=32, upsert_batch_size=256,
+                 embedding_cache_dir=None, versions_path=DEFAULT_VERSIONS_PATH, backend="torch"):
         self.model_name = model_name
         self.collection_name = collection_name
         self.sparse_model_name = "bm25"
-        self.model = SentenceTransformer(self.model_name, trust_remote_code=True, cache_folder=cache_folder)
+        self.backend = backend  # "torch", "onnx" or "onnx-int8", see `setup_model`
+        self.model = setup_model(self.model_name, cache_folder=cache_folder, backend=backend)
         self.emb_dimensions = self.model.get_sentence_embedding_dimension()
+        self.embedding_cache = shared_cache(embedding_cache_dir, model_cache_key(model_name, backend), self.emb_dimensions) if embedding_cache_dir else None
+        self.versions_path = versions_path
+        self.encode_batch_size = encode_batch_size
+        self.upsert_batch_size = upsert_batch_size
         self.meta = {}
         self.content = []
 
@@ -37,9 +114,16 @@ class EmbeddingUploader:
             self.meta = {}
         return meta_found
 
+    def read_title(self, content_path):
+        """Manual title from the `_meta.json` next to `content_path` (see `manual_title`)."""
+        meta_path = sibling(content_path, "_meta.json")
+        if not (os.path.exists(meta_path) and self.read_metadata(meta_path)):
+            self.meta = {}
+        return manual_title(self.meta)
+
 
-    def upload_embeddings(self, content_path, qdrant_url="http://localhost:6333"):
-        client = QdrantClient(qdrant_url)
+    def upload_embeddings(self, content_path, qdrant_url="http://localhost:6333", incremental=False, manifest_path=None, client=None):
+        client = client or QdrantClient(qdrant_url)
         if not client.collection_exists(self.collection_name):
             client.create_collection(
                 collection_name=self.collection_name,
@@ -59,34 +143,80 @@ class EmbeddingUploader:
         assert [self.model_name] == vec_keys, f"Collection '{self.collection_name}' vector config does not match model '{self.model_name}'"
    
 
-        data_content = json.loads(pathlib.Path(content_path).read_text())
-        points = []
-        root_chapter = ""
-        title = self.meta.get('title', 'Unknown Manual')
-        for index, chapter in enumerate(data_content):
-            if chapter[0] == 1:
-                root_chapter = chapter[1]
-            point = models.PointStruct(
-                id=index,
-                vector=self.model.encode(chapter[-1]).tolist(),
-                payload={
-                    "content": chapter[-1],
-                    "main_chapter": root_chapter,
-                    "chapter": chapter[1],
-                    "manual": title,
-                    "page": chapter[2]
-                }
-            )
-            points.append(point)
-        client.upsert(
-            collection_name=self.collection_name,
-            points=points
-        )
-        return len(points)
+        data_content = load_rows(content_path)
+        title = self.read_title(content_path)
+
+        def build_points(batch, vectors):
+            return [
+                models.PointStruct(
+                    id=pid,
+                    vector=vector.tolist(),
+                    payload={
+                        "content": chapter[-1],
+                        "main_chapter": root_chapter,
+                        "chapter": chapter[1],
+                        "manual": title,
+                        "source": source,
+                        "page": chapter[2]
+                    }
+                )
+                for (pid, root_chapter, chapter), vector in zip(batch, vectors)
+            ]
+
+        source = manual_source(content_path)
+        manifest_path = manifest_path or self.manifest_path(content_path)
+        return self._sync_points(client, data_content, title, source, build_points, manifest_path, incremental,
+                                 total=len(data_content))
 
-    def upload_hybrid_embeddings(self, content_path, qdrant_url="http://localhost:6333"):
-        client = QdrantClient(qdrant_url)
+    def upload_hybrid_embeddings(self, content_path, qdrant_url="http://localhost:6333", incremental=False, manifest_path=None, client=None,
+                                 quantization=None, on_disk=False, hnsw_m=None, hnsw_ef_construct=None):
+        """
+        Storage options (applied on creation, and to an existing collection when given):
+        `quantization` "int8"/"binary" keeps a compressed copy of the dense vectors in RAM,
+        `on_disk` moves the original vectors (and the sparse index) to disk, `hnsw_m` /
+        `hnsw_ef_construct` tune the dense HNSW graph. Match them at query time with `Search(hnsw_ef=...)`.
+        """
+        client = client or QdrantClient(qdrant_url)
+        self.ensure_hybrid_collection(client, quantization, on_disk, hnsw_m, hnsw_ef_construct)
+
+        data_content = load_rows(content_path)
+        title = self.read_title(content_path)
+        source = manual_source(content_path)
+        print("Uploading hybrid embeddings for manual:", title)
+
+        manifest_path = manifest_path or self.manifest_path(content_path)
+        return self._sync_points(client, data_content, title, source, self._hybrid_points(title, source), manifest_path,
+                                 incremental, total=len(data_content))
+
+    def stream_hybrid_embeddings(self, rows, title, source, manifest_path, qdrant_url="http://localhost:6333", incremental=False,
+                                 client=None, **storage_options):
+        """
+        Same as `upload_hybrid_embeddings` for an iterable of `[level, title, page, text]` rows
+        (e.g. `TextChunker.iter_chunks`), consumed `upsert_batch_size` rows at a time: earlier
+        batches are searchable while later rows are still being produced, and a slow upsert
+        blocks the producer instead of buffering rows. `source` is the manual's `manual_source`.
+        """
+        client = client or QdrantClient(qdrant_url)
+        self.ensure_hybrid_collection(client, **storage_options)
+        print("Streaming hybrid embeddings for manual:", title)
+        return self._sync_points(client, rows, title, source, self._hybrid_points(title, source), manifest_path, incremental)
+
+    def ensure_hybrid_collection(self, client, quantization=None, on_disk=False, hnsw_m=None, hnsw_ef_construct=None):
+        """Creates the dense + sparse collection (or applies storage options to it) and validates its config."""
+        quantization_params = quantization_config(quantization)
+        hnsw_params = hnsw_config(hnsw_m, hnsw_ef_construct)
         if client.collection_exists(self.collection_name):
+            if quantization_params is not None or hnsw_params is not None or on_disk:
+                client.update_collection(
+                    collection_name=self.collection_name,
+                    vectors_config={
+                        self.model_name: models.VectorParamsDiff(
+                            quantization_config=quantization_params,
+                            hnsw_config=hnsw_params,
+                            on_disk=on_disk or None,
+                        )
+                    }
+                )
             config = client.get_collection(self.collection_name)
         else:
             client.create_collection(
@@ -94,12 +224,16 @@ class EmbeddingUploader:
                 vectors_config={
                     self.model_name: models.VectorParams(
                         size=self.emb_dimensions, # type: ignore
-                        distance=models.Distance.COSINE
+                        distance=models.Distance.COSINE,
+                        on_disk=on_disk or None,
+                        hnsw_config=hnsw_params,
+                        quantization_config=quantization_params,
                     ),
                 },
                 sparse_vectors_config={
                     self.sparse_model_name: models.SparseVectorParams(
                         modifier=models.Modifier.IDF,
+                        index=models.SparseIndexParams(on_disk=True) if on_disk else None,
                     )
                 }
             )
@@ -117,41 +251,210 @@ class EmbeddingUploader:
             raise AssertionError(f"Collection '{self.collection_name}' missing sparse_vectors config")
         sparse_keys = list(sparse.keys()) if hasattr(sparse, "keys") else list(sparse)
         assert [self.sparse_model_name] == sparse_keys, f"Collection '{self.collection_name}' sparse vector config does not match model '{self.sparse_model_name}'"
-        
-        data_content = json.loads(pathlib.Path(content_path).read_text())
-        points = []
-        meta_path = content_path.replace("_chunked.json", "_meta.json")
-        meta_found = self.read_metadata(meta_path)
-        if meta_found:
-            title = self.meta.get('title', 'Unknown Manual')
-        else:
-            title = 'Unknown Manual'
-        print("Uploading hybrid embeddings for manual:", title)
-        root_chapter = ""
-        for index, chapter in enumerate(data_content):
-            if chapter[0] == 1:
-                root_chapter = chapter[1]
-            point = models.PointStruct(
-                id=index,
-                vector={
-                    self.model_name: self.model.encode(chapter[-1]).tolist(),
-                    self.sparse_model_name: models.Document(
-                        text=chapter[-1],
-                        model="Qdrant/"+self.sparse_model_name,
-                    ),
-                },
-                payload={
-                    "content": chapter[-1],
-                    "main_chapter": root_chapter,
-                    "chapter": chapter[1],
-                    "manual": title,
-                    "page": chapter[2]
-                }
+
+    def _hybrid_points(self, title, source):
+        def build_points(batch, vectors):
+            return [
+                models.PointStruct(
+                    id=pid,
+                    vector={
+                        self.model_name: vector.tolist(),
+                        self.sparse_model_name: models.Document(
+                            text=chapter[-1],
+                            model="Qdrant/"+self.sparse_model_name,
+                        ),
+                    },
+                    payload={
+                        "content": chapter[-1],
+                        "main_chapter": root_chapter,
+                        "chapter": chapter[1],
+                        "manual": title,
+                        "source": source,
+                        "page": chapter[2]
+                    }
+                )
+                for (pid, root_chapter, chapter), vector in zip(batch, vectors)
+            ]
+        return build_points
+
+    def encode(self, texts):
+        """Batch-encodes texts, reusing vectors from the embedding cache when one is configured."""
+        if self.embedding_cache is not None:
+            return self.embedding_cache.encode(self.model, texts, batch_size=self.encode_batch_size)
+        return self.model.encode(texts, batch_size=self.encode_batch_size)
+
+    def manifest_path(self, content_path):
+        """Default manifest location: next to the chunked file, one manifest per collection."""
+        return sibling(content_path, f"_{self.collection_name}_manifest.json")
+
+    def index_entries(self, data_content, source):
+        """Returns (point_id, root_chapter, chapter) for every chunk, in file order."""
+        return list(self.iter_entries(data_content, source))
+
+    def iter_entries(self, rows, source):
+        return iter_point_entries(rows, source)
+
+    def read_manifest(self, manifest_path):
+        if not os.path.exists(manifest_path):
+            return {}
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def write_manifest(self, manifest_path, title, point_ids, source=None):
+        manifest = {
+            "collection": self.collection_name,
+            "manual": title,
+            "source": source,
+            "model": self.model_name,
+            "points": sorted(point_ids),
+        }
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+    def _existing_ids(self, client, point_ids, batch_size=1000):
+        """Ids from `point_ids` that are actually stored in the collection."""
+        point_ids = list(point_ids)
+        existing = set()
+        for start in range(0, len(point_ids), batch_size):
+            records = client.retrieve(
+                collection_name=self.collection_name,
+                ids=point_ids[start:start + batch_size],
+                with_payload=False,
+                with_vectors=False
             )
-            points.append(point)
-        print(f"Uploading {len(points)} points to collection '{self.collection_name}'...")
-        client.upsert(
-            collection_name=self.collection_name,
-            points=points
-        )
-        return len(points)
\ No newline at end of file
+            existing.update(str(record.id) for record in records)
+        return existing
+
+    def _sync_points(self, client, rows, title, source, build_points, manifest_path, incremental, total=None):
+        """
+        Upserts chunks under deterministic ids and deletes points of this manual that are listed
+        in the previous manifest but no longer produced. With `incremental`, chunks already indexed
+        (present in both the manifest and the collection) are not re-embedded.
+        `rows` is consumed once, lazily; stale points are deleted after the last upsert.
+        Without a manifest (first run, or a collection ingested with the old sequential ids),
+        legacy integer-id points holding this file's rows are deleted instead (see `_delete_legacy`).
+        """
+        manifest = self.read_manifest(manifest_path)
+        previous_ids = set(manifest.get("points", [])) if manifest.get("model") == self.model_name else set()
+        current_ids = set()
+        row_hashes = []  # content hash per row index, to recognise legacy points without a manifest
+
+        def entries():
+            for entry in self.iter_entries(rows, source):
+                current_ids.add(entry[0])
+                if not manifest:
+                    row_hashes.append(content_hash(entry[2][-1]))
+                yield entry
+
+        print(f"Uploading points to collection '{self.collection_name}'...")
+        skip_ids = previous_ids if incremental else set()
+        uploaded = self._stream_upsert(client, self._point_batches(entries(), build_points, client, skip_ids), None if skip_ids else total)
+        if skip_ids:
+            print(f"Incremental mode: {len(current_ids) - uploaded} chunks unchanged, {uploaded} embedded")
+
+        stale_ids = previous_ids - current_ids
+        if stale_ids:
+            print(f"Deleting {len(stale_ids)} stale points from '{self.collection_name}'...")
+            client.delete(
+                collection_name=self.collection_name,
+                points_selector=models.PointIdsList(points=sorted(stale_ids))
+            )
+        if not manifest:
+            stale_ids = self._delete_legacy(client, row_hashes)
+        self.write_manifest(manifest_path, title, current_ids, source)
+        if uploaded or stale_ids:
+            # collection content changed: cached answers for it are no longer valid
+            bump_collection_version(self.collection_name, self.versions_path)
+        return uploaded
+
+    def _delete_legacy(self, client, row_hashes, batch_size=1000):
+        """
+        Before deterministic ids, the chunk at row `i` of a file was stored under integer id `i`
+        (the same ids for every manual). Deletes integer points `0..len(row_hashes)-1` whose
+        content is this file's row at that index, so other manuals are never touched.
+        Returns the ids deleted.
+        """
+        legacy = []
+        for start in range(0, len(row_hashes), batch_size):
+            records = client.retrieve(
+                collection_name=self.collection_name,
+                ids=list(range(start, min(start + batch_size, len(row_hashes)))),
+                with_payload=["content"],
+                with_vectors=False
+            )
+            legacy += [record.id for record in records
+                       if content_hash((record.payload or {}).get("content", "")) == row_hashes[record.id]]
+        if legacy:
+            print(f"No manifest: deleting {len(legacy)} points stored under the old sequential ids...")
+            client.delete(collection_name=self.collection_name, points_selector=models.PointIdsList(points=legacy))
+        return legacy
+
+    def _point_batches(self, entries, build_points, client=None, skip_ids=()):
+        """
+        Producer side: pulls entries `upsert_batch_size` at a time, drops those listed in
+        `skip_ids` that are still stored in the collection, encodes the rest and yields lists of
+        at most `upsert_batch_size` points, built by `build_points(batch_entries, vectors)`.
+        """
+        step = max(self.upsert_batch_size, 1)
+        entries = iter(entries)
+        pending = []
+        exhausted = False
+        while not exhausted:
+            batch = list(itertools.islice(entries, step))
+            exhausted = not batch
+            if skip_ids and batch:
+                indexed = self._existing_ids(client, [pid for pid, _, _ in batch if pid in skip_ids])
+                batch = [entry for entry in batch if entry[0] not in indexed]
+            pending += batch
+            while len(pending) >= step or (pending and exhausted):
+                ready, pending = pending[:step], pending[step:]
+                vectors = self.encode([chapter[-1] for _, _, chapter in ready])
+                yield build_points(ready, vectors)
+
+    def _stream_upsert(self, client, point_batches, total, queue_size=4):
+        """
+        Consumer side: upserts point batches from a background thread while the caller keeps
+        encoding the next ones. Intermediate batches are sent with wait=False, the last one with
+        wait=True so the collection is consistent when this returns. Returns number of points.
+        """
+        pending = queue.Queue(maxsize=queue_size)
+        errors = []
+        uploaded = [0]
+        started = time.perf_counter()
+
+        def consumer():
+            held = None
+            while True:
+                batch = pending.get()
+                try:
+                    if errors:
+                        continue
+                    if held is not None:
+                        client.upsert(collection_name=self.collection_name, points=held, wait=batch is None)
+                        uploaded[0] += len(held)
+                        elapsed = time.perf_counter() - started
+                        print(f"Upserted {uploaded[0]}{'' if total is None else f'/{total}'} points ({uploaded[0] / max(elapsed, 1e-9):.1f} points/s)")
+                    held = batch
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    if batch is None:
+                        return
+
+        worker = threading.Thread(target=consumer, daemon=True)
+        worker.start()
+        try:
+            for batch in point_batches:
+                if errors:
+                    break
+                pending.put(batch)
+        finally:
+            pending.put(None)
+            worker.join()
+        if errors:
+            raise errors[0]
+        elapsed = time.perf_counter() - started
+        print(f"Uploaded {uploaded[0]} points to '{self.collection_name}' in {elapsed:.1f}s ({uploaded[0] / max(elapsed, 1e-9):.1f} points/s)")
+        return uploaded[0]
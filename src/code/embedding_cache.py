@@ -0,0 +1,206 @@
+import atexit
+import hashlib
+import os
+import re
+import threading
+import numpy as np
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process writer lock
+    fcntl = None
+
+_registry = {}  # (cache_dir, model_name, dim) -> EmbeddingCache, shared by every user in the process
+_registry_lock = threading.Lock()
+
+
+def shared_cache(cache_dir, model_name, dim, **options):
+    """The process-wide `EmbeddingCache` for `cache_dir` and model; created on first use."""
+    key = (os.path.abspath(cache_dir), model_name, int(dim))
+    with _registry_lock:
+        if key not in _registry:
+            _registry[key] = EmbeddingCache(cache_dir, model_name, dim, **options)
+        return _registry[key]
+
+
+class EmbeddingCache:
+    """
+    Content-addressed, size-bounded embedding cache stored on disk.
+
+    Vectors live in a memory-mapped float32 matrix (`<model>_<dim>.f32`), one row per entry,
+    and the 16-byte text digest stored in each row lives in `<model>_<dim>.keys`. The index
+    (`<model>_<dim>.idx.npy`) maps a digest to its row and a last-used counter; when the
+    matrix is full the least recently used rows are reused. A lookup only hits if the row
+    still holds the digest, so a stale index (crash before flush, another process) never
+    returns a foreign vector. One file set per model.
+
+    Safe across threads; get instances through `shared_cache` so a process opens each
+    cache once. Across processes the first one to open a cache takes an exclusive lock
+    and writes; the others use it read-only.
+    """
+    INDEX_DTYPE = np.dtype([("key", "u1", (16,)), ("row", "<i8"), ("tick", "<i8")])
+
+    def __init__(self, cache_dir, model_name, dim, max_entries=200_000, evict_fraction=0.1, flush_every=256):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.dim = int(dim)
+        self.max_entries = int(max_entries)
+        self.evict_fraction = evict_fraction
+        self.flush_every = flush_every
+        os.makedirs(cache_dir, exist_ok=True)
+        stem = re.sub(r"[^A-Za-z0-9_.-]", "_", model_name) + f"_{self.dim}"
+        self.vectors_path = os.path.join(cache_dir, stem + ".f32")
+        self.keys_path = os.path.join(cache_dir, stem + ".keys")
+        self.index_path = os.path.join(cache_dir, stem + ".idx.npy")
+        self._lock = threading.Lock()
+        self._dirty = 0
+        self.hits = 0
+        self.misses = 0
+        self.index = {}  # digest -> [row, tick]
+        self._tick = 0
+        self._free_rows = []
+
+        self._lock_file = open(os.path.join(cache_dir, stem + ".lock"), "a")
+        self.read_only = False
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.read_only = True
+                print(f"Embedding cache {self.vectors_path} is in use by another process, opening it read-only")
+
+        expected_sizes = {self.vectors_path: self.max_entries * self.dim * np.dtype(np.float32).itemsize,
+                          self.keys_path: self.max_entries * 16}
+        reuse = all(os.path.exists(path) and os.path.getsize(path) == size for path, size in expected_sizes.items())
+        if self.read_only and not reuse:
+            self.vectors = self.keys = None  # the writer owns (re)creating the files
+            return
+        mode = "r+" if reuse else "w+"  # capacity/dimension changed: start from scratch
+        if self.read_only:
+            mode = "r"
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode=mode, shape=(self.max_entries, self.dim))
+        self.keys = np.memmap(self.keys_path, dtype=np.uint8, mode=mode, shape=(self.max_entries, 16))
+        if mode != "w+" and os.path.exists(self.index_path):
+            for key, row, tick in np.load(self.index_path):
+                if row < self.max_entries:
+                    self.index[key.tobytes()] = [int(row), int(tick)]
+                    self._tick = max(self._tick, int(tick))
+        if self.read_only:
+            return
+        used = {row for row, _ in self.index.values()}
+        self._free_rows = [row for row in range(self.max_entries - 1, -1, -1) if row not in used]
+        atexit.register(self.flush)
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_many(self, texts):
+        """Returns a list with a vector copy for each cached text and None for misses."""
+        if self.vectors is None:
+            self.misses += len(texts)
+            return [None] * len(texts)
+        with self._lock:
+            found = []
+            for text in texts:
+                key = self.key(text)
+                entry = self.index.get(key)
+                vector = self._read_row(entry[0], key) if entry is not None else None
+                if vector is None:
+                    if entry is not None:
+                        del self.index[key]  # row was reused since the index was written
+                    found.append(None)
+                    self.misses += 1
+                    continue
+                self._tick += 1
+                entry[1] = self._tick
+                found.append(vector)
+                self.hits += 1
+            return found
+
+    def _read_row(self, row, key):
+        """Copy of the row's vector if the row still holds `key` (checked around the copy)."""
+        if self.keys[row].tobytes() != key:
+            return None
+        vector = np.array(self.vectors[row])
+        return vector if self.keys[row].tobytes() == key else None
+
+    def put_many(self, texts, vectors):
+        if self.read_only:
+            return
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = self.key(text)
+                entry = self.index.get(key)
+                if entry is None:
+                    if not self._free_rows:
+                        self._evict()
+                    entry = [self._free_rows.pop(), 0]
+                    self.index[key] = entry
+                self._tick += 1
+                entry[1] = self._tick
+                row = entry[0]
+                self.keys[row] = 0  # invalid while the vector is written
+                self.vectors[row] = vector
+                self.keys[row] = np.frombuffer(key, dtype=np.uint8)
+                self._dirty += 1
+            if self._dirty >= self.flush_every:
+                self._flush_locked()
+
+    def _evict(self):
+        """Drops the least recently used `evict_fraction` of entries and frees their rows."""
+        count = max(1, int(len(self.index) * self.evict_fraction))
+        keys = list(self.index.keys())
+        ticks = np.fromiter((self.index[k][1] for k in keys), dtype=np.int64, count=len(keys))
+        oldest = np.argpartition(ticks, count - 1)[:count] if count < len(keys) else np.arange(len(keys))
+        for position in oldest:
+            row, _ = self.index.pop(keys[position])
+            self._free_rows.append(row)
+        self._flush_locked()  # the saved index must not point at rows about to be reused
+
+    def encode(self, model, texts, batch_size=32, **encode_kwargs):
+        """
+        Drop-in replacement for `model.encode(texts)`: cached vectors are reused and only
+        misses are sent to the model, in one batch. Accepts a single string or a list.
+        """
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        found = self.get_many(texts)
+        missing = [i for i, vector in enumerate(found) if vector is None]
+        if missing:
+            encoded = model.encode([texts[i] for i in missing], batch_size=batch_size, **encode_kwargs)
+            encoded = np.asarray(encoded, dtype=np.float32)
+            self.put_many([texts[i] for i in missing], encoded)
+            for i, vector in zip(missing, encoded):
+                found[i] = vector
+        result = np.vstack(found) if found else np.empty((0, self.dim), dtype=np.float32)
+        return result[0] if single else result
+
+    def _flush_locked(self):
+        if self.read_only:
+            return
+        self.vectors.flush()
+        self.keys.flush()
+        index = np.empty(len(self.index), dtype=self.INDEX_DTYPE)
+        for position, (key, (row, tick)) in enumerate(self.index.items()):
+            index[position] = (np.frombuffer(key, dtype=np.uint8), row, tick)
+        tmp_path = self.index_path + ".tmp.npy"
+        np.save(tmp_path, index)
+        os.replace(tmp_path, self.index_path)
+        self._dirty = 0
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.index),
+            "capacity": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,235 @@
+"""
+Parallel, cached ingestion of many manuals: PDF -> `_content.json` -> `_chunked.json` -> Qdrant
+(`_content.jsonl` / `_chunked.jsonl` row files with `--row_format jsonl`, see `rows.py`).
+
+Each PDF is a small DAG (convert -> chunk -> embed). Conversion and chunking run in a process
+pool whose workers load the tokenizer once; embedding runs in this process with one model,
+as soon as each manual's chunks are ready. A stage is skipped only when its cache key
+(hash of the stage input + stage parameters + stage version) matches the last successful run
+and its output still exists, so changed inputs or parameters are always redone.
+
+    python -m src.code.ingest data/ --collection manuals --workers 4
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from src.code import chunking
+
+# bump when a stage's output format or logic changes, to invalidate cached results
+STAGE_VERSIONS = {"convert": 1, "chunk": 1, "embed": 1}
+
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StageCache:
+    """JSON map `<stage>:<output>` -> cache key of the last successful run."""
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(stage, input_path, params):
+        payload = json.dumps({"stage": stage, "version": STAGE_VERSIONS[stage], "input": file_hash(input_path), "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def fresh(self, stage, output, key):
+        return self.entries.get(f"{stage}:{output}") == key
+
+    def record(self, stage, output, key):
+        self.entries[f"{stage}:{output}"] = key
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def _convert(pdf_path, image_path, margins, row_format):
+    from src.code.pdf_to_md import PDFToMarkdown
+    PDFToMarkdown(pdf_path, image_path=image_path, margins=tuple(margins)).run(row_format=row_format)
+    return os.path.splitext(pdf_path)[0] + "_content." + row_format
+
+
+def _chunk(content_path, chunked_path, token_limit):
+    # tokenizer loaded once per worker by `chunking._init_worker`
+    chunking._worker_chunker.chunk_file(content_path, chunked_path, token_limit=token_limit)
+    return chunked_path
+
+
+class IngestionRunner:
+    def __init__(self, collection, model_name="all-mpnet-base-v2", qdrant_url="http://localhost:6333", workers=2,
+                 token_limit=300, image_path="data/images", margins=(50, 75), cache_path="data/ingest_cache.json",
+                 embed=True, force=False, backend="torch", embedding_cache_dir=None, encode_batch_size=32,
+                 upsert_batch_size=256, upload_options=None, tokenizer_name=None, row_format="json"):
+        self.collection = collection
+        self.model_name = model_name
+        self.tokenizer_name = tokenizer_name or "sentence-transformers/" + model_name
+        self.qdrant_url = qdrant_url
+        self.workers = workers
+        self.token_limit = token_limit
+        self.image_path = image_path
+        self.margins = list(margins)
+        self.cache = StageCache(cache_path)
+        self.embed = embed
+        self.force = force
+        self.backend = backend
+        self.embedding_cache_dir = embedding_cache_dir
+        self.encode_batch_size = encode_batch_size
+        self.upsert_batch_size = upsert_batch_size
+        self.upload_options = upload_options or {}
+        self.row_format = row_format
+        self._uploader = None
+        self._client = None
+
+    @staticmethod
+    def find_pdfs(paths):
+        pdfs = []
+        for path in paths:
+            pdfs += sorted(glob.glob(os.path.join(path, "*.pdf"))) if os.path.isdir(path) else [path]
+        return pdfs
+
+    def params(self, stage):
+        if stage == "convert":
+            return {"margins": self.margins, "row_format": self.row_format}
+        if stage == "chunk":
+            return {"tokenizer": self.tokenizer_name, "token_limit": self.token_limit, "row_format": self.row_format}
+        return {"model": self.model_name, "backend": self.backend, "collection": self.collection,
+                "qdrant_url": self.qdrant_url, **self.upload_options}
+
+    def _check(self, stage, input_path, output):
+        """Returns (cache_key, skip)."""
+        key = StageCache.key(stage, input_path, self.params(stage))
+        skip = not self.force and self.cache.fresh(stage, output, key)
+        if stage == "embed":
+            skip = skip and self.client().collection_exists(self.collection)  # collection dropped since
+        else:
+            skip = skip and os.path.exists(output)
+        return key, skip
+
+    def client(self):
+        if self._client is None:
+            from qdrant_client import QdrantClient
+            self._client = QdrantClient(self.qdrant_url)
+        return self._client
+
+    def _embed(self, chunked_path):
+        if self._uploader is None:  # one model for the whole run
+            from src.code.embedding import EmbeddingUploader
+            self._uploader = EmbeddingUploader(
+                model_name=self.model_name, collection_name=self.collection, backend=self.backend,
+                encode_batch_size=self.encode_batch_size, upsert_batch_size=self.upsert_batch_size,
+                embedding_cache_dir=self.embedding_cache_dir)
+        self._uploader.upload_hybrid_embeddings(chunked_path, qdrant_url=self.qdrant_url, incremental=True,
+                                                client=self.client(), **self.upload_options)
+        return chunked_path
+
+    def run(self, paths):
+        """Ingests PDFs (files or directories); returns {"ran": {stage: n}, "skipped": {...}}."""
+        pdfs = self.find_pdfs(paths)
+        summary = {"ran": dict.fromkeys(STAGE_VERSIONS, 0), "skipped": dict.fromkeys(STAGE_VERSIONS, 0)}
+        failures = []
+        print(f"Ingesting {len(pdfs)} PDFs with {self.workers} workers")
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=chunking._init_worker,
+                                 initargs=(self.tokenizer_name,)) as pool, \
+                ThreadPoolExecutor(max_workers=1) as embed_pool:
+            running = {}  # future -> (stage, pdf, output, key)
+
+            def schedule(stage, pdf):
+                stem = os.path.splitext(pdf)[0]
+                content, chunked = f"{stem}_content.{self.row_format}", f"{stem}_chunked.{self.row_format}"
+                if stage == "convert":
+                    input_path, output = pdf, content
+                elif stage == "chunk":
+                    input_path, output = content, chunked
+                elif stage == "embed" and self.embed:
+                    # full path: same-named PDFs in different directories are different manuals
+                    input_path, output = chunked, f"{self.collection}/{os.path.normpath(stem)}"
+                else:
+                    return
+                key, skip = self._check(stage, input_path, output)
+                if skip:
+                    summary["skipped"][stage] += 1
+                    print(f"[{stage}] {os.path.basename(pdf)}: up to date")
+                    return schedule(next_stage(stage), pdf)
+                print(f"[{stage}] {os.path.basename(pdf)}: running")
+                if stage == "convert":
+                    future = pool.submit(_convert, pdf, self.image_path, self.margins, self.row_format)
+                elif stage == "chunk":
+                    future = pool.submit(_chunk, input_path, output, self.token_limit)
+                else:
+                    future = embed_pool.submit(self._embed, input_path)
+                running[future] = (stage, pdf, output, key)
+
+            for pdf in pdfs:
+                schedule("convert", pdf)
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, pdf, output, key = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"[{stage}] {os.path.basename(pdf)} failed: {e}")
+                        failures.append((pdf, stage))
+                        continue
+                    self.cache.record(stage, output, key)
+                    summary["ran"][stage] += 1
+                    schedule(next_stage(stage), pdf)
+        print(f"Done. ran: {summary['ran']}, skipped: {summary['skipped']}")
+        if failures:
+            raise RuntimeError(f"Ingestion failed for {len(failures)} PDFs: {failures}")
+        return summary
+
+
+def next_stage(stage):
+    stages = list(STAGE_VERSIONS)
+    index = stages.index(stage) + 1
+    return stages[index] if index < len(stages) else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert, chunk and embed PDFs in parallel, skipping unchanged work")
+    parser.add_argument("paths", nargs="+", help="PDF files or directories containing PDFs")
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--model_name", default="all-mpnet-base-v2")
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx", "onnx-int8"])
+    parser.add_argument("--qdrant_url", default=os.environ.get("QDRANT_URL", "http://localhost:6333"))
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--token_limit", type=int, default=300)
+    parser.add_argument("--cache_path", default="data/ingest_cache.json")
+    parser.add_argument("--embedding_cache_dir", default=None)
+    parser.add_argument("--encode_batch_size", type=int, default=32)
+    parser.add_argument("--upsert_batch_size", type=int, default=256)
+    parser.add_argument("--quantization", default=None, choices=["int8", "binary"])
+    parser.add_argument("--on_disk", action="store_true")
+    parser.add_argument("--row_format", default="json", choices=["json", "jsonl"], help="Intermediate content/chunk file format")
+    parser.add_argument("--no_embed", action="store_true", help="Stop after chunking")
+    parser.add_argument("--force", action="store_true", help="Ignore the stage cache")
+    args = parser.parse_args()
+    upload_options = {}
+    if args.quantization:
+        upload_options["quantization"] = args.quantization
+    if args.on_disk:
+        upload_options["on_disk"] = True
+    IngestionRunner(
+        args.collection, model_name=args.model_name, qdrant_url=args.qdrant_url, workers=args.workers,
+        token_limit=args.token_limit, cache_path=args.cache_path, embed=not args.no_embed, force=args.force,
+        backend=args.backend, embedding_cache_dir=args.embedding_cache_dir, encode_batch_size=args.encode_batch_size,
+        upsert_batch_size=args.upsert_batch_size, upload_options=upload_options, row_format=args.row_format,
+    ).run(args.paths)
+
+
+if __name__ == "__main__":
+    main()
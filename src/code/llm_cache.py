@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from src.code.tracing import llm_usage
+
+class LLMCache:
+    """
+    Disk-backed memoization of chat completions in a SQLite file.
+    Keys are a hash of model, rendered prompt and request parameters; identical calls are
+    served from disk with no LLM round trip. The token usage of the original call is stored
+    with each entry so traces of cache hits still report it. Safe to share between threads and processes.
+    """
+    def __init__(self, path="./data/llm_cache.sqlite"):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(completions)")]
+        if "usage" not in columns:  # files created before usage was stored
+            self._conn.execute("ALTER TABLE completions ADD COLUMN usage TEXT")
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model, prompt, params=None):
+        payload = json.dumps({"model": model, "prompt": prompt, "params": params or {}}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        return self.lookup(key)[0]
+
+    def lookup(self, key):
+        """(response, usage) of a cached entry, (None, {}) when missing."""
+        with self._lock:
+            row = self._conn.execute("SELECT response, usage FROM completions WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None, {}
+        return row[0], json.loads(row[1]) if row[1] else {}
+
+    def set(self, key, model, response, usage=None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, model, response, created, usage) VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, time.time(), json.dumps(usage or {}))
+            )
+            self._conn.commit()
+
+    def complete(self, client, prompt, model, refresh=False, **params):
+        """Cached `client.chat.completions.create`; `refresh` skips the lookup and overwrites."""
+        return self.complete_with_usage(client, prompt, model, refresh=refresh, **params)[0]
+
+    def complete_with_usage(self, client, prompt, model, refresh=False, **params):
+        """Like `complete`, returns (content, usage, cached); on a hit usage is the original call's."""
+        key = self.key(model, prompt, params)
+        if not refresh:
+            cached, usage = self.lookup(key)
+            if cached is not None:
+                self.hits += 1
+                return cached, usage, True
+        self.misses += 1
+        response = client.chat.completions.create(
+            model=model,
+            messages=[{'role': 'user', 'content': prompt }],
+            **params
+        )
+        return self._store(key, model, response) + (False,)
+
+    async def acomplete(self, client, prompt, model, refresh=False, **params):
+        """Async variant of `complete` for AsyncOpenAI clients."""
+        return (await self.acomplete_with_usage(client, prompt, model, refresh=refresh, **params))[0]
+
+    async def acomplete_with_usage(self, client, prompt, model, refresh=False, **params):
+        """Async variant of `complete_with_usage`."""
+        key = self.key(model, prompt, params)
+        if not refresh:
+            cached, usage = self.lookup(key)
+            if cached is not None:
+                self.hits += 1
+                return cached, usage, True
+        self.misses += 1
+        response = await client.chat.completions.create(
+            model=model,
+            messages=[{'role': 'user', 'content': prompt }],
+            **params
+        )
+        return self._store(key, model, response) + (False,)
+
+    def _store(self, key, model, response):
+        content, usage = response.choices[0].message.content, llm_usage(response)
+        if content is not None:
+            self.set(key, model, content, usage)
+        return content, usage
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
@@ -0,0 +1,267 @@
+"""
+In-process retrieval backend with the same interface as `Search`, for small deployments,
+CI and offline work where no Qdrant server is available.
+
+- dense: float32 matrix of normalized embeddings (memory-mapped from disk), cosine top-k
+  via one matmul + argpartition;
+- sparse: BM25 document weights in a CSR-style matrix indexed by term (postings), scored with
+  IDF at query time like Qdrant's `Modifier.IDF` sparse vectors;
+- hybrid: RRF fusion over dense and sparse prefetches, matching `Search.rrf_search`.
+
+Build from `_chunked.json` files and save once, then `LocalIndex.load` starts instantly:
+
+    python -m src.code.local_backend data/manual_chunked.json --output data/local_index
+"""
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import re
+import time
+from collections import Counter
+import numpy as np
+from src.code.embedding import iter_point_entries, manual_source, manual_title
+from src.code.rows import load_rows, sibling
+from src.code.search import unique_points
+from src.code.search_history import get_history_writer
+from src.code.tracing import current_trace, span
+
+RRF_K = 2  # Qdrant's default rank constant: score = sum(1 / (k + rank)), rank from 0
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class LocalPoint:
+    """Minimal stand-in for qdrant `ScoredPoint`: id, score, payload."""
+    __slots__ = ("id", "score", "payload")
+
+    def __init__(self, id, score, payload):
+        self.id = id
+        self.score = score
+        self.payload = payload
+
+    def __repr__(self):
+        return f"LocalPoint(id={self.id!r}, score={self.score:.4f}, payload={self.payload!r})"
+
+
+class LocalIndex:
+    def __init__(self, ids, payloads, vectors, vocab, indptr, doc_ids, weights, idf, model_name):
+        self.ids = ids
+        self.payloads = payloads
+        self.vectors = vectors
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.idf = idf
+        self.model_name = model_name
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, content_paths, model, model_name, batch_size=32, k1=1.2, b=0.75):
+        """Builds an index from one or more `_chunked.json(l)` files (payloads as in EmbeddingUploader)."""
+        ids, payloads, texts = [], [], []
+        for content_path in content_paths:
+            content_path = str(content_path)
+            meta_path = sibling(content_path, "_meta.json")
+            meta = json.loads(pathlib.Path(meta_path).read_text()) if os.path.exists(meta_path) else {}
+            title, source = manual_title(meta), manual_source(content_path)
+            for pid, root_chapter, chapter in iter_point_entries(load_rows(content_path), source):
+                ids.append(pid)
+                payloads.append({
+                    "content": chapter[-1],
+                    "main_chapter": root_chapter,
+                    "chapter": chapter[1],
+                    "manual": title,
+                    "source": source,
+                    "page": chapter[2]
+                })
+                texts.append(chapter[-1])
+
+        vectors = np.asarray(model.encode(texts, batch_size=batch_size), dtype=np.float32).reshape(len(texts), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+
+        # BM25 document-side weights, grouped by term (postings) for fast query-time scoring
+        tokenized = [Counter(tokenize(text)) for text in texts]
+        lengths = np.array([sum(tf.values()) for tf in tokenized], dtype=np.float32)
+        avgdl = float(lengths.mean()) if len(lengths) else 0.0
+        vocab = {}
+        postings = []
+        for doc, term_freqs in enumerate(tokenized):
+            norm = k1 * (1 - b + b * lengths[doc] / avgdl) if avgdl else k1
+            for term, tf in term_freqs.items():
+                term_id = vocab.setdefault(term, len(vocab))
+                if term_id == len(postings):
+                    postings.append([])
+                postings[term_id].append((doc, tf * (k1 + 1) / (tf + norm)))
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(p) for p in postings])
+        doc_ids = np.fromiter((doc for p in postings for doc, _ in p), dtype=np.int32, count=int(indptr[-1]))
+        weights = np.fromiter((w for p in postings for _, w in p), dtype=np.float32, count=int(indptr[-1]))
+        doc_freq = np.diff(indptr).astype(np.float64)
+        idf = np.log((len(texts) - doc_freq + 0.5) / (doc_freq + 0.5) + 1).astype(np.float32)
+        return cls(ids, payloads, vectors, vocab, indptr, doc_ids, weights, idf, model_name)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "vectors.npy"), np.ascontiguousarray(self.vectors, dtype=np.float32))
+        np.savez(os.path.join(path, "bm25.npz"), indptr=self.indptr, doc_ids=self.doc_ids, weights=self.weights, idf=self.idf)
+        with open(os.path.join(path, "index.json"), 'w', encoding='utf-8') as f:
+            json.dump({"model_name": self.model_name, "ids": self.ids, "vocab": self.vocab}, f, ensure_ascii=False)
+        with open(os.path.join(path, "payloads.jsonl"), 'w', encoding='utf-8') as f:
+            for payload in self.payloads:
+                f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+
+    @classmethod
+    def load(cls, path):
+        """Loads a saved index; vectors stay memory-mapped, so startup does not read them."""
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        bm25 = np.load(os.path.join(path, "bm25.npz"))
+        with open(os.path.join(path, "index.json"), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        with open(os.path.join(path, "payloads.jsonl"), 'r', encoding='utf-8') as f:
+            payloads = [json.loads(line) for line in f]
+        return cls(index["ids"], payloads, vectors, index["vocab"], bm25["indptr"], bm25["doc_ids"],
+                   bm25["weights"], bm25["idf"], index["model_name"])
+
+    @staticmethod
+    def _top_k(scores, limit):
+        limit = min(limit, len(scores))
+        if limit <= 0:
+            return np.empty(0, dtype=np.int64)
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        return top[np.argsort(-scores[top], kind="stable")]
+
+    def dense_scores(self, vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return self.vectors @ (vector / norm if norm else vector)
+
+    def sparse_scores(self, text):
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term in set(tokenize(text)):
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            scores[self.doc_ids[start:end]] += self.idf[term_id] * self.weights[start:end]
+        return scores
+
+    def _points(self, order, scores):
+        return [LocalPoint(self.ids[i], float(scores[i]), self.payloads[i]) for i in order]
+
+    def _dense_top(self, vector, limit):
+        scores = self.dense_scores(vector)
+        return self._top_k(scores, limit), scores
+
+    def _sparse_top(self, text, limit):
+        scores = self.sparse_scores(text)
+        top = [i for i in self._top_k(scores, limit) if scores[i] > 0]  # like Qdrant: no term match, no hit
+        return top, scores
+
+    def dense_search(self, vector, limit=5):
+        return self._points(*self._dense_top(vector, limit))
+
+    def sparse_search(self, text, limit=5):
+        return self._points(*self._sparse_top(text, limit))
+
+    def rrf_search(self, text, vector, limit=5, prefetch_limit=None):
+        """Fuses dense and sparse prefetches (5 * limit each, as in `Search.rrf_search`) with RRF."""
+        prefetch_limit = prefetch_limit or 5 * limit
+        fused = Counter()
+        for ranked, _ in (self._dense_top(vector, prefetch_limit), self._sparse_top(text, prefetch_limit)):
+            for rank, doc in enumerate(ranked):
+                fused[int(doc)] += 1.0 / (RRF_K + rank)
+        return [LocalPoint(self.ids[doc], score, self.payloads[doc]) for doc, score in fused.most_common(limit)]
+
+
+class LocalSearch:
+    """Drop-in replacement for `Search` backed by a `LocalIndex`."""
+    def __init__(self, model, index, history_storage=None, embedding_cache=None):
+        self.model = model
+        self.index = index
+        self.model_name = index.model_name
+        self.history_storage = history_storage
+        self.embedding_cache = embedding_cache
+
+    def encode(self, query):
+        with span("embed", texts=1 if isinstance(query, str) else len(query)):
+            if self.embedding_cache is not None:
+                return self.embedding_cache.encode(self.model, query)
+            return self.model.encode(query)
+
+    def search(self, query, limit=5):
+        vector = self.encode(query)
+        with span("local_search") as s:
+            points = self.index.dense_search(vector, limit)
+            s.set(results=len(points))
+        return points
+
+    def search_with_history(self, query, limit=5):
+        """`search`, plus a history record like `Search.search_with_history` (none without `history_storage`)."""
+        start = time.perf_counter()
+        points = self.search(query, limit)
+        if self.history_storage is None:
+            return points
+        request = current_trace()
+        record = {}
+        record['query'] = query
+        record['ground_truth_points'] = []
+        record['limit'] = limit
+        record['result_points_scores'] = [(point.id, point.score) for point in points]
+        record['latency_ms'] = (time.perf_counter() - start) * 1000
+        record['stages'] = request.stages() if request is not None else {}
+        get_history_writer(self.history_storage).write(record)
+        return points
+
+    def rrf_search(self, query: str, limit: int = 5):
+        vector = self.encode(query)
+        with span("local_rrf_search") as s:
+            points = self.index.rrf_search(query, vector, limit)
+            s.set(results=len(points))
+        return points
+
+    def rrf_search_with_dense(self, query: str, limit: int = 5):
+        vector = self.encode(query)
+        with span("local_rrf_search", dense=True) as s:
+            points = self.index.rrf_search(query, vector, limit)
+            dense = float(self.index.dense_scores(vector).max()) if len(self.index) else None
+            s.set(results=len(points))
+        return points, dense
+
+    async def arrf_search(self, query: str, limit: int = 5):
+        return await asyncio.to_thread(self.rrf_search, query, limit)
+
+    def rrf_search_batch(self, queries: list[str], limit: int = 5):
+        if not queries:
+            return [], []
+        vectors = self.encode(queries)
+        with span("local_batch_search", queries=len(queries)) as s:
+            per_query = [self.index.rrf_search(query, vector, limit) for query, vector in zip(queries, vectors)]
+            unique = unique_points(per_query)
+            s.set(results=len(unique))
+        return per_query, unique
+
+
+def main():
+    from src.code.model_setup import setup_model
+    parser = argparse.ArgumentParser(description="Build a local (Qdrant-free) retrieval index from chunked JSON files")
+    parser.add_argument("content_paths", nargs="+", help="*_chunked.json(l) files")
+    parser.add_argument("--output", "-o", default="data/local_index", help="Index directory")
+    parser.add_argument("--model_name", default="all-mpnet-base-v2", help="SentenceTransformer model name")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx", "onnx-int8"], help="Embedding runtime")
+    args = parser.parse_args()
+    index = LocalIndex.build(args.content_paths, setup_model(args.model_name, backend=args.backend), args.model_name, batch_size=args.batch_size)
+    index.save(args.output)
+    print(f"Saved local index with {len(index)} chunks to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
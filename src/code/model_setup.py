@@ -1,18 +1,97 @@
 from sentence_transformers import SentenceTransformer
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+import numpy as np
+import platform
+import re
+import threading
 import toml, os
+from src.code.tracing import span
 
-def setup_model(model_name='all-mpnet-base-v2', cache_folder="./models"):
-    print(f"Loading model {model_name}...", end=" ")
-    model = SentenceTransformer(
-        model_name,
-        trust_remote_code=True,
-        cache_folder=cache_folder
-    )
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+_models = {}  # (model_name, backend, cache_folder) -> loaded model, see `shared_model`
+_models_lock = threading.Lock()
+
+def quantization_target():
+    """ONNX Runtime dynamic quantization preset matching this CPU."""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "arm64"
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            flags = f.read()
+    except OSError:
+        return "avx2"
+    if "avx512_vnni" in flags:
+        return "avx512_vnni"
+    if "avx512f" in flags:
+        return "avx512"
+    return "avx2"
+
+def model_cache_key(model_name, backend="torch"):
+    """Name for embedding caches: vectors from different backends are not interchangeable."""
+    return model_name if backend == "torch" else f"{model_name}@{backend}"
+
+def _onnx_int8_model(model_name, cache_folder):
+    """
+    Loads the dynamically int8-quantized ONNX export of `model_name`, exporting it into
+    `<cache_folder>/<model>-onnx-int8` on first use.
+    """
+    from sentence_transformers.backend import export_dynamic_quantized_onnx_model
+    target = quantization_target()
+    export_dir = os.path.join(cache_folder, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name) + "-onnx-int8")
+    file_name = f"onnx/model_qint8_{target}.onnx"
+    if not os.path.exists(os.path.join(export_dir, file_name)):
+        print(f"exporting int8 ONNX model ({target})...", end=" ")
+        model = SentenceTransformer(model_name, backend="onnx", trust_remote_code=True, cache_folder=cache_folder)
+        model.save(export_dir)
+        export_dynamic_quantized_onnx_model(model, target, export_dir, file_suffix=f"qint8_{target}")
+    return SentenceTransformer(export_dir, backend="onnx", model_kwargs={"file_name": file_name}, trust_remote_code=True)
+
+def setup_model(model_name='all-mpnet-base-v2', cache_folder="./models", backend="torch"):
+    """
+    `backend`: "torch" (PyTorch), "onnx" (ONNX Runtime, exported on first use) or "onnx-int8"
+    (ONNX with dynamic int8 quantization; faster CPU encoding and less RAM, check with
+    `benchmarks/check_embedding_parity.py`).
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+    print(f"Loading model {model_name} ({backend})...", end=" ")
+    with span("model_load", model=model_name, backend=backend):
+        if backend == "onnx-int8":
+            model = _onnx_int8_model(model_name, cache_folder)
+        else:
+            model = SentenceTransformer(
+                model_name,
+                trust_remote_code=True,
+                cache_folder=cache_folder,
+                backend=backend
+            )
     print(f"DONE")
     return model
 
+def shared_model(model_name='all-mpnet-base-v2', cache_folder="./models", backend="torch"):
+    """`setup_model`, loaded once per process and shared by every caller (e.g. one RagEngine per collection)."""
+    key = (model_name, backend, os.path.abspath(cache_folder))
+    with _models_lock:
+        if key not in _models:
+            _models[key] = setup_model(model_name, cache_folder=cache_folder, backend=backend)
+        return _models[key]
+
+def embedding_parity(reference, candidate, texts, batch_size=32):
+    """Cosine similarity between the embeddings two models give the same texts."""
+    a = np.asarray(reference.encode(texts, batch_size=batch_size), dtype=np.float32)
+    b = np.asarray(candidate.encode(texts, batch_size=batch_size), dtype=np.float32)
+    a /= np.linalg.norm(a, axis=1, keepdims=True)
+    b /= np.linalg.norm(b, axis=1, keepdims=True)
+    cosine = np.sum(a * b, axis=1)
+    return {"mean": float(cosine.mean()), "min": float(cosine.min()), "p01": float(np.percentile(cosine, 1))}
+
 def setup_llm_client(secrets_path):
     config = toml.load(secrets_path)
     os.environ["OPENAI_API_KEY"] = config["openai"]["OPENAI_API_KEY"]
     return OpenAI()
+
+def setup_async_llm_client(secrets_path):
+    config = toml.load(secrets_path)
+    os.environ["OPENAI_API_KEY"] = config["openai"]["OPENAI_API_KEY"]
+    return AsyncOpenAI()
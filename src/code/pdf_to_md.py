@@ -4,6 +4,223 @@ import json
 import unicodedata
 import difflib
 import os
+import numpy as np
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from src.code.rows import write_rows
+
+def normalize_text(s: str) -> str:
+    """Normalize unicode, remove punctuation/symbols and collapse whitespace."""
+    if s is None:
+        return ""
+    # normalize fullwidth vs ascii, combine characters consistently
+    s = unicodedata.normalize("NFKC", s)
+    s = s.strip().lower()
+    # remove punctuation and symbol characters, keep letters/numbers/spaces
+    s = re.sub(r"[\p{P}\p{S}]", "", s)
+    s = re.sub(r"\s+", " ", s)
+    return s
+
+
+class TocMatcher:
+    """
+    Matches TOC titles to markdown chapters (keys of `chunk_dict`) with the same results as a
+    full scan (unique substring match first, otherwise best `difflib` ratio above a threshold,
+    first candidate wins ties), without comparing every title against every chapter.
+
+    - candidate keys are normalized once;
+    - substring candidates come from a character n-gram inverted index: a key containing the
+      title must contain the title's rarest n-gram, and a key contained in the title must have
+      its own rarest n-gram ("signature") among the title's n-grams;
+    - fuzzy scoring is bounded by difflib's quick_ratio (character multiset overlap), computed
+      for all candidates at once with numpy; full `SequenceMatcher.ratio` only runs on candidates
+      whose bound can still reach the threshold / current best, highest bound first.
+
+    Keys added to `chunk_dict` later can be indexed with `add`, so a streaming caller keeps
+    one matcher instead of rebuilding it.
+    """
+    def __init__(self, chunk_dict, ngram=3):
+        self.chunk_dict = chunk_dict
+        self.ngram = ngram
+        self.keys = list(chunk_dict.keys())
+        self.positions = {key: index for index, key in enumerate(self.keys)}
+        self.norm = [normalize_text(key) for key in self.keys]
+        self.alive = np.ones(len(self.keys), dtype=bool)
+        self.lengths = np.array([len(s) for s in self.norm], dtype=np.int64)
+        self.alphabet = {}
+        for s in self.norm:
+            for ch in s:
+                self.alphabet.setdefault(ch, len(self.alphabet))
+        self.char_counts = np.zeros((len(self.keys), max(len(self.alphabet), 1)), dtype=np.int32)
+        for index, s in enumerate(self.norm):
+            for ch in s:
+                self.char_counts[index, self.alphabet[ch]] += 1
+        self._matchers = {}
+
+        gram_sets = [self._grams(s) for s in self.norm]
+        self.doc_freq = doc_freq = Counter(gram for grams in gram_sets for gram in grams)
+        self.postings = defaultdict(list)
+        self.signatures = defaultdict(list)
+        self.short = []
+        for index, grams in enumerate(gram_sets):
+            for gram in grams:
+                self.postings[gram].append(index)
+            if grams:
+                self.signatures[min(grams, key=lambda g: (doc_freq[g], g))].append(index)
+            else:
+                self.short.append(index)
+
+    def _reserve(self, rows, columns):
+        """Grows the per-key arrays (doubling) to hold `rows` keys over `columns` characters."""
+        capacity, width = self.char_counts.shape
+        if rows <= capacity and columns <= width:
+            return
+        new_capacity = max(rows, 2 * capacity, 16) if rows > capacity else capacity
+        new_width = max(columns, 2 * width) if columns > width else width
+        char_counts = np.zeros((new_capacity, new_width), dtype=np.int32)
+        char_counts[:capacity, :width] = self.char_counts
+        alive = np.zeros(new_capacity, dtype=bool)
+        alive[:capacity] = self.alive
+        lengths = np.zeros(new_capacity, dtype=np.int64)
+        lengths[:capacity] = self.lengths
+        self.char_counts, self.alive, self.lengths = char_counts, alive, lengths
+
+    def add(self, key):
+        """Indexes `chunk_dict[key]` as a candidate; a key that is still unmatched keeps its place."""
+        index = self.positions.get(key)
+        if index is not None and self.alive[index]:
+            return index
+        norm = normalize_text(key)
+        index = len(self.keys)
+        self.keys.append(key)
+        self.norm.append(norm)
+        self.positions[key] = index
+        for ch in norm:
+            self.alphabet.setdefault(ch, len(self.alphabet))
+        self._reserve(index + 1, len(self.alphabet))
+        self.alive[index] = True
+        self.lengths[index] = len(norm)
+        for ch in norm:
+            self.char_counts[index, self.alphabet[ch]] += 1
+        grams = self._grams(norm)
+        self.doc_freq.update(grams)
+        for gram in grams:
+            self.postings[gram].append(index)
+        if grams:
+            self.signatures[min(grams, key=lambda g: (self.doc_freq[g], g))].append(index)
+        else:
+            self.short.append(index)
+        return index
+
+    def _grams(self, s):
+        return {s[i:i + self.ngram] for i in range(len(s) - self.ngram + 1)}
+
+    def substring_matches(self, norm_title):
+        """Alive candidate indices (in chunk_dict order) where title and key contain one another."""
+        grams = self._grams(norm_title)
+        if grams:
+            rarest = min(grams, key=lambda g: len(self.postings.get(g, ())))
+            shortlist = set(self.postings.get(rarest, ()))
+            for gram in grams:
+                shortlist.update(self.signatures.get(gram, ()))
+            shortlist.update(self.short)
+        else:
+            shortlist = range(len(self.keys))
+        return [
+            index for index in sorted(shortlist)
+            if self.alive[index] and (norm_title in self.norm[index] or self.norm[index] in norm_title)
+        ]
+
+    def ratio(self, index, norm_title):
+        # SequenceMatcher caches its analysis of seq2, so keep one per candidate
+        matcher = self._matchers.get(index)
+        if matcher is None:
+            matcher = self._matchers[index] = difflib.SequenceMatcher(None, "", self.norm[index])
+        matcher.set_seq1(norm_title)
+        return matcher.ratio()
+
+    def best_fuzzy(self, norm_title, threshold, eps=1e-9):
+        candidates = np.flatnonzero(self.alive)
+        title_counts = np.zeros(self.char_counts.shape[1], dtype=np.int32)
+        for ch in norm_title:
+            column = self.alphabet.get(ch)
+            if column is not None:
+                title_counts[column] += 1
+        total = len(norm_title) + self.lengths[candidates]
+        overlap = np.minimum(self.char_counts[candidates], title_counts).sum(axis=1)
+        bound = np.where(total > 0, 2.0 * overlap / np.maximum(total, 1), 1.0)
+        keep = bound >= threshold - eps
+        candidates, bound = candidates[keep], bound[keep]
+        best_index, best_score = None, -1.0
+        for position in np.lexsort((candidates, -bound)):
+            if bound[position] < best_score - eps:
+                break
+            index = int(candidates[position])
+            score = self.ratio(index, norm_title)
+            if score > best_score or (score == best_score and index < best_index):
+                best_index, best_score = index, score
+        if best_index is not None and best_score >= threshold:
+            return best_index
+        return None
+
+    def find_best_match(self, title, threshold=0.80):
+        """Returns the index of the matching chapter key or None."""
+        if not self.alive.any():
+            return None
+        norm_title = normalize_text(title)
+        substring_matches = self.substring_matches(norm_title)
+        if len(substring_matches) == 1:
+            return substring_matches[0]
+        # none or ambiguous: fall through to fuzzy scoring
+        return self.best_fuzzy(norm_title, threshold)
+
+    def take(self, index):
+        """Marks a chapter as matched, removes it from chunk_dict and returns its content."""
+        self.alive[index] = False
+        return self.chunk_dict.pop(self.keys[index])
+
+    def match(self, toc, thresholds=(0.80, 0.70)):
+        """Appends matched content to TOC entries; returns entries still unmatched."""
+        pending = toc
+        for threshold in thresholds:
+            retries = []
+            for chapter in pending:
+                index = self.find_best_match(chapter[1], threshold=threshold)
+                if index is not None:
+                    chapter.append(self.take(index))
+                else:
+                    retries.append(chapter)
+            pending = retries
+        return pending
+
+
+def convert_pages(doc, headers, page_numbers, margins, image_path):
+    """Converts the given pages of an open document to markdown, one page at a time."""
+    parts = []
+    for number in page_numbers:
+        page = doc[number]
+        clusters = page.cluster_drawings()
+        for bb in clusters:
+            page.draw_rect(bb, width=0.2)# type: ignore
+        parts.append(pymupdf4llm.to_markdown(
+            doc,
+            pages=[number],
+            margins=margins,
+            hdr_info=headers,
+            write_images=True,
+            image_path=image_path,
+            force_text=False
+        ))
+    return "".join(parts)
+
+def _convert_page_range(input_filepath, page_numbers, margins, image_path):
+    """Process-pool worker: opens its own document handle and converts a page range."""
+    doc = pymupdf.open(input_filepath)
+    try:
+        headers = pymupdf4llm.TocHeaders(doc) # type: ignore
+        return convert_pages(doc, headers, page_numbers, margins, image_path)
+    finally:
+        doc.close()
 
 class PDFToMarkdown:
     def __init__(self, input_filepath, image_path="data/images", margins=(50,75)):
@@ -20,28 +237,118 @@ class PDFToMarkdown:
         self._meta_start = "<!--METADATA_START-->"
         self._meta_end = "<!--METADATA_END-->"
 
-    def extract_markdown(self):
-        for page in self.doc[self.content_first_page : self.doc.page_count]:
-            clusters = page.cluster_drawings()
-            for bb in clusters:
-                page.draw_rect(bb, width=0.2)# type: ignore
-            self.md += pymupdf4llm.to_markdown(
-                self.doc,
-                pages=[page.number],
-                margins=self.margins,
-                hdr_info=self.my_headers,
-                write_images=True,
-                image_path=self.image_path,
-                force_text=False
+    def page_ranges(self, parts):
+        """Splits content pages into at most `parts` contiguous, ordered ranges."""
+        pages = list(range(self.content_first_page, self.doc.page_count))
+        parts = max(1, min(parts, len(pages)))
+        size, extra = divmod(len(pages), parts)
+        ranges, start = [], 0
+        for index in range(parts):
+            end = start + size + (1 if index < extra else 0)
+            ranges.append(pages[start:end])
+            start = end
+        return ranges
+
+    def extract_markdown(self, workers=1):
+        """
+        Converts content pages to markdown. With workers > 1 pages are split into ranges
+        (a few per worker, for load balancing) converted in a process pool and joined in order.
+        """
+        if workers <= 1:
+            pages = range(self.content_first_page, self.doc.page_count)
+            self.md += convert_pages(self.doc, self.my_headers, pages, self.margins, self.image_path)
+            return self.md
+        ranges = self.page_ranges(workers * 4)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = executor.map(
+                _convert_page_range,
+                [self.input_filepath] * len(ranges),
+                ranges,
+                [self.margins] * len(ranges),
+                [self.image_path] * len(ranges),
             )
+            self.md += "".join(parts)
         return self.md
     
 
-    def export_json(self, toc):
-        out_path = os.path.splitext(self.input_filepath)[0] + '_content.json'
-        os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
-        with open(out_path, 'w', encoding='utf-8') as f:
-            json.dump(toc, f, ensure_ascii=False, indent=2)
+    def iter_markdown(self, workers=1, pages_per_task=4):
+        """
+        Yields the markdown of the content pages in order, as (first_page_index, markdown) pairs.
+        With workers > 1 page ranges are converted in a process pool, at most `2 * workers` ranges
+        ahead of the consumer.
+        """
+        pages = list(range(self.content_first_page, self.doc.page_count))
+        if workers <= 1:
+            for number in pages:
+                yield number, convert_pages(self.doc, self.my_headers, [number], self.margins, self.image_path)
+            return
+        ranges = [pages[start:start + pages_per_task] for start in range(0, len(pages), pages_per_task)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            in_flight = deque()
+            for page_range in ranges:
+                in_flight.append((page_range[0], executor.submit(
+                    _convert_page_range, self.input_filepath, page_range, self.margins, self.image_path)))
+                if len(in_flight) >= 2 * workers:
+                    number, future = in_flight.popleft()
+                    yield number, future.result()
+            while in_flight:
+                number, future = in_flight.popleft()
+                yield number, future.result()
+
+    def iter_chapters(self, workers=1, thresholds=(0.80, 0.70)):
+        """
+        Streaming counterpart of `run`: yields `[level, title, page, text]` TOC entries in TOC
+        order while pages are still being converted. Only the section being written and the
+        sections not yet claimed by a TOC entry are kept in memory.
+
+        A TOC entry is matched once every section starting on or before its page is complete,
+        against those sections only (not the whole document as in `match_toc`), so ambiguous
+        titles can resolve differently than in `run`. Entries without a match are yielded
+        without text, as `match_toc` leaves them.
+
+        Sections left unclaimed by every TOC entry raise an AssertionError, as in `match_toc`, but
+        only once the last page is converted: entries yielded before that may already be indexed
+        (`stream_pdf` then writes no manifest, and the next run replaces those points).
+        """
+        toc = self.doc.get_toc() # type: ignore
+        sections = {}  # complete, unclaimed sections: first line -> text
+        buffer, buffer_page = "", self.content_first_page  # section being written, page it started on
+        matcher = TocMatcher(sections)  # indexes sections as they complete, see `add`
+        position = 0
+
+        def add_section(part):
+            key = part.split('\n', 1)[0]
+            sections[key] = part
+            matcher.add(key)
+
+        def ready(upto_page):
+            nonlocal position
+            while position < len(toc) and (upto_page is None or toc[position][2] - 1 < upto_page):
+                chapter = toc[position]
+                position += 1
+                if not sections or matcher.match([chapter], thresholds=thresholds):
+                    print(f"No content matched for TOC entry '{chapter[1]}'")
+                yield chapter
+
+        for number, page_md in self.iter_markdown(workers=workers):
+            parts = re.split(r'\n(?=#)', buffer + self._clean(page_md))
+            for part in parts[:-1]:
+                add_section(re.sub(r'^#+\s', '', part))
+            if len(parts) > 1:
+                buffer_page = number
+            buffer = parts[-1]
+            # sections starting before `buffer_page` are all complete
+            yield from ready(buffer_page)
+        if buffer:
+            add_section(re.sub(r'^#+\s', '', buffer))
+        remaining = list(ready(None))  # matched before yielding, so a failure stops them from being indexed
+        assert len(sections) == 0, f"Unmatched chunks remain: {list(sections.keys())}"
+        yield from remaining
+
+    def export_json(self, toc, row_format="json"):
+        """Writes `_content.json`, or `_content.jsonl` + offsets index with row_format="jsonl" (see `rows.py`)."""
+        out_path = os.path.splitext(self.input_filepath)[0] + '_content.' + row_format
+        write_rows(out_path, toc, row_format)
         return toc
 
 
@@ -73,9 +380,13 @@ class PDFToMarkdown:
         print(f"Wrote metadata to {out_path}")
 
 
-    def clean_markdown(self):
+    @staticmethod
+    def _clean(md):
         pattern = r"[^a-zA-Z0-9!@#$%^&*()_\-+=\[\]{}|;:'\",.<>/?\\` \t\n□△◇：±℃φ×Ω（）]"
-        self.md = re.sub(pattern, "", self.md)
+        return re.sub(pattern, "", md)
+
+    def clean_markdown(self):
+        self.md = self._clean(self.md)
 
     def split_markdown(self):
         self.output = re.split(r'\n(?=#)', self.md)
@@ -88,75 +399,17 @@ class PDFToMarkdown:
 
     def match_toc(self, chunk_dict):
         toc = self.doc.get_toc() # type: ignore
-
-        def normalize_text(s: str) -> str:
-            """Normalize unicode, remove punctuation/symbols and collapse whitespace."""
-            if s is None:
-                return ""
-            # normalize fullwidth vs ascii, combine characters consistently
-            s = unicodedata.normalize("NFKC", s)
-            s = s.strip().lower()
-            # remove punctuation and symbol characters, keep letters/numbers/spaces
-            s = re.sub(r"[\p{P}\p{S}]", "", s)
-            s = re.sub(r"\s+", " ", s)
-            return s
-
-        # helper to try to find a single best match for a title
-        def find_best_match(title: str, candidates: list, threshold: float = 0.80):
-            norm_title = normalize_text(title)
-            if not candidates:
-                return None
-            # first try simple substring match on normalized text
-            substring_matches = [item for item in candidates if norm_title in normalize_text(item[0]) or normalize_text(item[0]) in norm_title]
-            if len(substring_matches) == 1:
-                return substring_matches[0]
-            if len(substring_matches) > 1:
-                # ambiguous: fall through to fuzzy scoring
-                pass
-
-            # compute similarity scores and pick best
-            scores = []
-            for key, val in candidates:
-                score = difflib.SequenceMatcher(None, norm_title, normalize_text(key)).ratio()
-                scores.append((key, val, score))
-            best = max(scores, key=lambda x: x[2])
-            if best[2] >= threshold:
-                return (best[0], best[1])
-            return None
-
-        retries = []
-        # First pass: strict/substring or high-threshold fuzzy matching
-        for chapter in toc:
-            title = chapter[1]
-            candidates = list(chunk_dict.items())
-            match = find_best_match(title, candidates, threshold=0.80)
-            if match is not None:
-                key, content = match
-                chapter.append(content)
-                chunk_dict.pop(key)
-            else:
-                retries.append(chapter)
-
-        # Second pass: try again with a lower threshold for the remaining chapters
-        still_retry = []
-        for chapter in retries:
-            title = chapter[1]
-            candidates = list(chunk_dict.items())
-            match = find_best_match(title, candidates, threshold=0.70)
-            if match is not None:
-                key, content = match
-                chapter.append(content)
-                chunk_dict.pop(key)
-            else:
-                still_retry.append(chapter)
+        # First pass: strict/substring or high-threshold fuzzy matching,
+        # second pass: lower threshold for the remaining chapters
+        TocMatcher(chunk_dict).match(toc, thresholds=(0.80, 0.70))
 
         # If anything remains unmatched, fail with a message showing leftovers
         assert len(chunk_dict) == 0, f"Unmatched chunks remain: {list(chunk_dict.keys())}"
         return toc
 
 
-    def run(self):
-        self.extract_markdown()
+    def run(self, workers=1, row_format="json"):
+        self.extract_markdown(workers=workers)
         self.save_metadata()
         self.clean_markdown()
         self.split_markdown()
@@ -164,5 +417,5 @@ class PDFToMarkdown:
         toc = self.match_toc(chunk_dict)
         # export matched toc as JSON file (existing behavior) with metadata
         # for later reading/parsing with read_text_with_metadata
-        self.export_json(toc)
+        self.export_json(toc, row_format=row_format)
         return toc
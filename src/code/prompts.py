@@ -1,23 +1,162 @@
+import os
+import re
+import threading
 import yaml
 from jinja2 import Template
 
+_registry = {}  # absolute path -> _PromptFile, shared by every loader in the process
+_registry_lock = threading.Lock()
+
+
+class _PromptFile:
+    """Parsed prompts and compiled templates of one YAML file, reloaded when its mtime changes."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.prompts = {}
+        self.templates = {}
+        self.refresh()
+
+    def refresh(self):
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self.stamp:
+            return
+        with self.lock:
+            if stamp == self.stamp:
+                return
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    prompts = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                if self.stamp is None:
+                    raise
+                print(f"Keeping previous prompts, {self.path} failed to parse: {e}")
+                return
+            self.prompts, self.templates, self.stamp = prompts, {}, stamp
+
+    def template(self, name):
+        self.refresh()
+        templates = self.templates
+        template = templates.get(name)
+        if template is None:
+            template = templates[name] = Template(self.prompts[name])
+        return template
+
+
+def estimate_tokens(text):
+    """Rough LLM token count (~4 characters per token); pass a real tokenizer's counter for exact budgets."""
+    return len(text) // 4 + 1
+
+
+def _shingles(text, size=3):
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+class ContextPacker:
+    """
+    Fits search results into a token budget for the assistant prompt.
+
+    Points are taken in descending score order (the fused RRF score); a point whose content is
+    a near-duplicate (word 3-gram Jaccard >= `duplicate_threshold`) of an already packed one is
+    dropped, and points that no longer fit are skipped. Packed chunks of the same manual chapter
+    on consecutive pages (or the same page) are merged into one block under a single header, in
+    page order; blocks follow the rank of their best chunk.
+    """
+    def __init__(self, token_budget=3000, duplicate_threshold=0.8, token_counter=estimate_tokens):
+        self.token_budget = token_budget
+        self.duplicate_threshold = duplicate_threshold
+        self.token_counter = token_counter
+
+    @staticmethod
+    def header(index, payload):
+        return f"{index}) Manual:\t{payload['manual']},\nMain Chapter:\t{payload['main_chapter']}\nChapter:\t{payload['chapter']}\nContent: "
+
+    def pack(self, search_results):
+        """Returns (context, stats)."""
+        ranked = sorted(enumerate(search_results), key=lambda item: (-(getattr(item[1], "score", None) or 0.0), item[0]))
+        blocks = []  # {"key": (manual, main_chapter, chapter), "pages": [first, last], "best": order, "header": tokens, "chunks": [(page, rank, content, payload)]}
+        packed_shingles = []
+        used = 0
+        duplicates = skipped = 0
+        for order, (rank, point) in enumerate(ranked):
+            payload = point.payload
+            content = payload["content"]
+            shingles = _shingles(content)
+            if any(len(shingles & other) / len(shingles | other) >= self.duplicate_threshold for other in packed_shingles):
+                duplicates += 1
+                continue
+            key = (payload["manual"], payload["main_chapter"], payload["chapter"])
+            page = payload.get("page") or 0
+            # blocks of this chapter the chunk continues; one on each side when it fills a one-page gap
+            touching = [block for block in blocks if block["key"] == key and block["pages"][0] - 1 <= page <= block["pages"][1] + 1]
+            cost = self.token_counter(content + "\n")
+            header = 0
+            if touching:
+                cost -= sum(block["header"] for block in touching[1:])
+            else:
+                header = self.token_counter(self.header(len(blocks), payload) + "\n")
+                cost += header
+            if self.token_budget is not None and used + cost > self.token_budget:
+                skipped += 1
+                continue
+            used += cost
+            packed_shingles.append(shingles)
+            if touching:
+                block = touching[0]
+                for other in touching[1:]:
+                    block["chunks"] += other["chunks"]
+                    block["pages"] = [min(block["pages"][0], other["pages"][0]), max(block["pages"][1], other["pages"][1])]
+                    block["best"] = min(block["best"], other["best"])
+                    blocks.remove(other)
+            else:
+                block = {"key": key, "pages": [page, page], "best": order, "header": header, "chunks": []}
+                blocks.append(block)
+            block["chunks"].append((page, rank, content, payload))
+            block["pages"] = [min(block["pages"][0], page), max(block["pages"][1], page)]
+
+        parts = []
+        for index, block in enumerate(sorted(blocks, key=lambda block: block["best"])):
+            chunks = sorted(block["chunks"], key=lambda chunk: (chunk[0], chunk[1]))
+            parts.append(self.header(index, chunks[0][3]) + "\n".join(chunk[2] for chunk in chunks) + "\n\n")
+        stats = {"chunks": len(search_results) - duplicates - skipped, "blocks": len(parts),
+                 "duplicates": duplicates, "over_budget": skipped, "context_tokens": used}
+        return "".join(parts), stats
+
+
 class PromptLoader:
-    def __init__(self, path: str = "src/code/prompts.yaml"):
-        with open(path, "r", encoding="utf-8") as f:
-            self.prompts = yaml.safe_load(f)
+    """
+    Named Jinja prompts from a YAML file. The file is parsed and each template compiled once per
+    process (shared across loaders) and reloaded when the file's mtime changes.
+    `context_token_budget` caps the retrieved context in `build_prompt` (None: no limit).
+    """
+    def __init__(self, path: str = "src/code/prompts.yaml", context_token_budget=None, token_counter=estimate_tokens):
+        key = os.path.abspath(path)
+        with _registry_lock:
+            if key not in _registry:
+                _registry[key] = _PromptFile(key)
+            self._file = _registry[key]
+        self.packer = ContextPacker(context_token_budget, token_counter=token_counter)
 
+    @property
+    def prompts(self):
+        self._file.refresh()
+        return self._file.prompts
 
     def render(self, name: str, **kwargs) -> str:
         """Render a named prompt with given variables."""
-        template = Template(self.prompts[name])
-        return template.render(**kwargs)
+        return self._file.template(name).render(**kwargs)
+
+    def pack_context(self, search_results):
+        """Returns (context, stats), see `ContextPacker`."""
+        return self.packer.pack(search_results)
 
     def build_prompt(self, query, search_results):
-        context = ""
-        for index, payload in enumerate(search_results):
-            context += f"{index}) Manual:\t{payload.payload['manual']},\nMain Chapter:\t{payload.payload['main_chapter']}\nChapter:\t{payload.payload['chapter']}\nContent: {payload.payload['content']}\n\n"
+        context, _ = self.pack_context(search_results)
         return self.render(
             "assistant_prompt",
             query=query,
             context=context
-        )
\ No newline at end of file
+        )
@@ -1,62 +1,445 @@
-from src.code.search import Search
+import asyncio
+import os
+import re
+import time
+from functools import lru_cache
+from src.code.search import Search, unique_points
+from src.code.embedding_cache import shared_cache
+from src.code.answer_cache import SemanticCache, query_codes
+from src.code.llm_cache import LLMCache
+from src.code.local_backend import LocalIndex, LocalSearch, tokenize
 from src.code.prompts import PromptLoader
-from src.code.model_setup import setup_model, setup_llm_client
+from src.code.model_setup import model_cache_key, shared_model, setup_llm_client, setup_async_llm_client
+from src.code.search_history import get_history_writer
+from src.code.tracing import Trace, current_trace, llm_usage, span, trace
 
-def llm(client, prompt, model='gpt-5-nano'):
-    response = client.chat.completions.create(
+def llm(client, prompt, model='gpt-5-nano', cache=None, refresh=False):
+    with span("llm", model=model) as s:
+        if cache is not None:
+            content, usage, cached = cache.complete_with_usage(client, prompt, model, refresh=refresh)
+            s.set(cached=cached, **usage)
+            return content
+        response = client.chat.completions.create(
+            model=model,
+            messages=[{'role': 'user', 'content': prompt }]
+        )
+        s.set(**llm_usage(response))
+        return response.choices[0].message.content
+
+async def allm(client, prompt, model='gpt-5-nano', cache=None, refresh=False):
+    with span("llm", model=model) as s:
+        if cache is not None:
+            content, usage, cached = await cache.acomplete_with_usage(client, prompt, model, refresh=refresh)
+            s.set(cached=cached, **usage)
+            return content
+        response = await client.chat.completions.create(
+            model=model,
+            messages=[{'role': 'user', 'content': prompt }]
+        )
+        s.set(**llm_usage(response))
+        return response.choices[0].message.content
+
+def llm_stream(client, prompt, model='gpt-5-nano', request_trace=None):
+    """
+    Yields answer tokens as they arrive (`stream=True`). The generator usually runs after the
+    request's `trace` block has exited, so the trace to attach the span to is passed explicitly.
+    """
+    stream = client.chat.completions.create(
         model=model,
-        messages=[{'role': 'user', 'content': prompt }]
+        messages=[{'role': 'user', 'content': prompt }],
+        stream=True,
+        stream_options={"include_usage": True}
     )
-    return response.choices[0].message.content
+    with (request_trace.span if request_trace else span)("llm", model=model, stream=True) as s:
+        for chunk in stream:
+            if chunk.usage is not None:
+                s.set(**llm_usage(chunk))
+            if chunk.choices and chunk.choices[0].delta.content:
+                if "first_token_seconds" not in s.attrs:
+                    s.set(first_token_seconds=time.perf_counter() - s.start)
+                yield chunk.choices[0].delta.content
+
+def parse_queries(text, query_count, original=None) -> list[str]:
+    """
+    Extracts up to `query_count` rewrites from an LLM answer, one per line. Numbering, bullets,
+    quotes, blank lines, duplicates and copies of the original query are dropped.
+    """
+    queries = []
+    for line in (text or "").splitlines():
+        line = re.sub(r"^\s*(?:[-*\u2022]|\d+[.)])\s*", "", line).strip().strip('"').strip()
+        if line and line not in queries and line != original:
+            queries.append(line)
+    return queries[:query_count]
+
+def refine_query(query, client, query_count, verbose = False, loader=None, cache=None, max_trials=2) -> list[str]:
+    loader = loader or PromptLoader()
+    prompt = loader.render(
+        "refine_query",
+        query=query,
+        query_count=query_count
+    )
+
+    # partial answers are kept; the LLM is asked again only when nothing usable came back
+    llm_queries = []
+    with span("refine") as s:
+        for trial in range(max_trials):
+            llm_queries = parse_queries(llm(client, prompt, cache=cache, refresh=trial > 0), query_count, query)
+            if llm_queries:
+                break
+        s.set(results=len(llm_queries), trials=trial + 1)
+    if verbose:
+        print(f"Prompt:\n{prompt}")
+        print(f"Refined queries:", *llm_queries, sep="\n")
+    return llm_queries
 
-def refine_query(query, client, query_count, verbose = False) -> list[str]:
-    loader = PromptLoader() 
+async def arefine_query(query, client, query_count, verbose = False, loader=None, cache=None, max_trials=2) -> list[str]:
+    loader = loader or PromptLoader()
     prompt = loader.render(
         "refine_query",
         query=query,
         query_count=query_count
     )
-      
+
     llm_queries = []
-    trials_count = 0
-    while len(llm_queries) != query_count :
-        trials_count += 1
-        if trials_count >= 3:
-            break
-        llm_queries = llm(client,prompt).split("\n")
+    with span("refine") as s:
+        for trial in range(max_trials):
+            llm_queries = parse_queries(await allm(client, prompt, cache=cache, refresh=trial > 0), query_count, query)
+            if llm_queries:
+                break
+        s.set(results=len(llm_queries), trials=trial + 1)
     if verbose:
         print(f"Prompt:\n{prompt}")
-        print(f"Refined queries:", *llm_queries, sep="\n")        
+        print(f"Refined queries:", *llm_queries, sep="\n")
     return llm_queries
-    
-def rag(query, secrets_path, collection, verbose_search=False, verbose_prompt=False):
-    loader = PromptLoader() 
-    llm_client = setup_llm_client(secrets_path=secrets_path)
-    searcher = Search(model=setup_model(),
-                    collection_name=collection, model_name="all-mpnet-base-v2", 
-                    history_storage="./data/search_history.jsonl",
-                    secrets_path=secrets_path)
-
-    llm_queries = refine_query(query, llm_client, 2)
-    search_set = set()
-    search_results = []
-    llm_queries.append(query)
-    for q in llm_queries:
-        print("Query: ", q)
-        results = searcher.rrf_search(q, 5)
-        result_ids = set([p.id for p in results])
-        unique_ids = result_ids - search_set
-        for result in results:
-            if result.id in unique_ids: #avoid duplicates to be sent to LLM
-                search_results.append(result)
-        search_set.update(result_ids) 
-    if verbose_search:
-        print(len(search_results), "results in total search\n")
-        print("Query search results:")
-        print(*search_results, sep="\n\n")
-    prompt = loader.build_prompt(query, search_results)
-    if verbose_prompt:
-        print("\n\nQuery prompt output:")
-        print(prompt)
-    message = llm(llm_client, prompt)
-    return message
\ No newline at end of file
+
+
+STOPWORDS = frozenset(
+    "a an and are at be by can do does for from how i if in is it me my of on or should the this to "
+    "what when where which why with you".split()
+)
+
+class RefinementGate:
+    """
+    Decides from the raw query's first-pass hybrid results how many LLM rewrites are worth it.
+    Signals on the top result: relative RRF score margin over the runner-up (`margin`), share of
+    the query's terms found in its chapter titles and content, with every code/number present
+    (`coverage`), and the best dense cosine score (`dense`). With `skip_signals` or more strong
+    signals refinement is skipped, with `shorten_signals` or more only `short_query_count`
+    rewrites are generated, otherwise `query_count`.
+
+    Margins are on the RRF (k=2) scale: a hit ranked first by both retrievers scores 1.0 and a
+    runner-up ranked second by both 2/3 (margin 0.33), so `margin=0.4` only fires when both
+    agree on the top hit and not on the runner-up; one retriever alone never exceeds 0.33.
+    Coverage only counts for queries with `min_terms` content terms or an error code, so a
+    single generic word ("reset") is not evidence.
+    """
+    def __init__(self, margin=0.4, coverage=0.8, dense=0.6, skip_signals=2, shorten_signals=1,
+                 query_count=2, short_query_count=1, min_terms=2):
+        self.margin = margin
+        self.coverage = coverage
+        self.min_terms = min_terms
+        self.dense = dense
+        self.skip_signals = skip_signals
+        self.shorten_signals = shorten_signals
+        self.query_count = query_count
+        self.short_query_count = short_query_count
+
+    def assess(self, query, points, dense_score=None):
+        """Returns {"decision": "skip"|"shorten"|"full", "query_count", "signals", "margin", "coverage", "dense"}."""
+        margin = coverage = 0.0
+        signals = []
+        if points:
+            top = points[0]
+            if len(points) > 1 and top.score:
+                margin = (top.score - points[1].score) / top.score
+            else:
+                margin = 1.0
+            terms = {term for term in tokenize(query) if term not in STOPWORDS}
+            found = set(tokenize(" ".join(str(top.payload.get(key) or "") for key in ("main_chapter", "chapter", "content"))))
+            coverage = len(terms & found) / len(terms) if terms else 0.0
+            if margin >= self.margin:
+                signals.append("margin")
+            codes = query_codes(query)
+            specific = len(terms) >= self.min_terms or bool(codes)
+            if specific and coverage >= self.coverage and codes <= found:
+                signals.append("coverage")
+            if dense_score is not None and dense_score >= self.dense:
+                signals.append("dense")
+        if len(signals) >= self.skip_signals:
+            decision, query_count = "skip", 0
+        elif len(signals) >= self.shorten_signals:
+            decision, query_count = "shorten", self.short_query_count
+        else:
+            decision, query_count = "full", self.query_count
+        return {"decision": decision, "query_count": query_count, "signals": signals,
+                "margin": round(margin, 4), "coverage": round(coverage, 4),
+                "dense": None if dense_score is None else round(float(dense_score), 4)}
+
+
+class RagEngine:
+    """Long-lived RAG backend: owns the embedding model, LLM and Qdrant clients and prompts.
+
+    Build it once per process (see `get_engine`) and call `answer(query)` per request.
+    Every request is traced per stage (see `tracing`); `last_trace` holds the latest one (of any caller: use the trace `answer_stream` returns when the engine is shared) and
+    `trace_log_path` (default: `RAG_TRACE_LOG` env var) appends each trace to a JSONL file.
+    `backend` selects the embedding runtime (see `setup_model`); `search_options` are passed to `Search`, e.g. `{"hnsw_ef": 64, "rescore": True}` for quantized collections.
+    `context_token_budget` caps the retrieved context in the answer prompt (see `prompts.ContextPacker`; None: no limit).
+    `refinement_gate` (True or a `RefinementGate`) searches the raw query first and skips or shortens
+    query refinement when that result is already confident; the decision is logged with the request.
+    """
+    def __init__(self, secrets_path, collection, model_name="all-mpnet-base-v2",
+                 history_storage="./data/search_history.jsonl", embedding_cache_dir="./models/query_embedding_cache",
+                 answer_cache=False, llm_cache_path=None, local_index_dir=None,
+                 qdrant_client=None, trace_log_path=None, search_options=None, backend="torch", context_token_budget=None,
+                 refinement_gate=None):
+        self.secrets_path = secrets_path
+        self.history_storage = history_storage
+        self.trace_log_path = trace_log_path or os.environ.get("RAG_TRACE_LOG")
+        self.collection = collection
+        self.loader = PromptLoader(context_token_budget=context_token_budget)
+        self.llm_client = setup_llm_client(secrets_path=secrets_path)
+        model = shared_model(model_name, backend=backend)
+        embedding_cache = None
+        if embedding_cache_dir:
+            embedding_cache = shared_cache(embedding_cache_dir, model_cache_key(model_name, backend), model.get_sentence_embedding_dimension())
+        if local_index_dir:
+            # in-process backend, no Qdrant server needed
+            self.searcher = LocalSearch(model, LocalIndex.load(local_index_dir),
+                                        history_storage=history_storage, embedding_cache=embedding_cache)
+        else:
+            self.searcher = Search(model=model,
+                            collection_name=collection, model_name=model_name,
+                            history_storage=history_storage,
+                            secrets_path=secrets_path,
+                            embedding_cache=embedding_cache,
+                            client=qdrant_client,
+                            **(search_options or {}))
+        self.llm_cache = LLMCache(llm_cache_path) if llm_cache_path else None
+        self.answer_cache = SemanticCache() if answer_cache is True else (answer_cache or None)
+        self.refinement_gate = RefinementGate() if refinement_gate is True else (refinement_gate or None)
+        self._async_llm_client = None
+        self.last_timings = {}
+        self.last_trace = None
+
+    @property
+    def async_llm_client(self):
+        if self._async_llm_client is None:
+            self._async_llm_client = setup_async_llm_client(secrets_path=self.secrets_path)
+        return self._async_llm_client
+
+    def warmup(self):
+        """Run a dummy encode so the first real query does not pay lazy init costs."""
+        self.searcher.model.encode("warmup")
+        return self
+
+    def cache_lookup(self, query):
+        """Returns (query_embedding, cached_entry); both None when the answer cache is disabled."""
+        if self.answer_cache is None:
+            return None, None
+        query_embedding = self.searcher.encode(query)
+        with span("cache_lookup") as s:
+            cached = self.answer_cache.lookup(self.collection, query, query_embedding)
+            s.set(hit=cached is not None)
+        if cached is not None:
+            print(f"Answer cache hit (similarity {cached['similarity']:.3f}) for: {cached['query']}")
+        return query_embedding, cached
+
+    def cache_store(self, query, query_embedding, message, search_results, latency):
+        if self.answer_cache is not None:
+            self.answer_cache.store(self.collection, query, query_embedding, message, search_results, latency)
+
+    def retrieve(self, query, verbose_search=False):
+        """Query refinement + hybrid search; returns deduplicated points for the prompt."""
+        with span("retrieve") as s:
+            if self.refinement_gate is not None:
+                first_results, dense_score = self.searcher.rrf_search_with_dense(query, 5)
+                plan = self.plan_refinement(query, first_results, dense_score)
+                s.set(refinement=plan["decision"])
+                llm_queries = refine_query(query, self.llm_client, plan["query_count"], loader=self.loader,
+                                           cache=self.llm_cache) if plan["query_count"] else []
+                for q in llm_queries + [query]:
+                    print("Query: ", q)
+                per_query, _ = self.searcher.rrf_search_batch(llm_queries, 5)
+                search_results = unique_points(per_query + [first_results])
+            else:
+                llm_queries = refine_query(query, self.llm_client, 2, loader=self.loader, cache=self.llm_cache)
+                llm_queries.append(query)
+                for q in llm_queries:
+                    print("Query: ", q)
+                _, search_results = self.searcher.rrf_search_batch(llm_queries, 5)
+            s.set(results=len(search_results))
+        if verbose_search:
+            print(len(search_results), "results in total search\n")
+            print("Query search results:")
+            print(*search_results, sep="\n\n")
+        return search_results
+
+    def plan_refinement(self, query, first_results, dense_score):
+        """Runs the refinement gate and records its decision on the current request."""
+        plan = self.refinement_gate.assess(query, first_results, dense_score)
+        request = current_trace()
+        if request is not None:
+            request.attrs["refinement"] = plan
+        print(f"Refinement: {plan['decision']} (signals: {', '.join(plan['signals']) or 'none'})")
+        return plan
+
+    def build_prompt(self, query, search_results, verbose_prompt=False):
+        with span("build_prompt", results=len(search_results)) as s:
+            context, stats = self.loader.pack_context(search_results)
+            prompt = self.loader.render("assistant_prompt", query=query, context=context)
+            s.set(**stats)
+        if verbose_prompt:
+            print("\n\nQuery prompt output:")
+            print(prompt)
+        return prompt
+
+    def log_request(self, request, search_results):
+        """Queues the request's latency, stage timings and result scores for the search history."""
+        if not self.history_storage:
+            return
+        get_history_writer(self.history_storage).write({
+            "query": request.attrs.get("query"),
+            "type": request.name,
+            "cache_hit": bool(request.attrs.get("cache_hit")),
+            "refinement": request.attrs.get("refinement"),
+            "result_points_scores": [(point.id, point.score) for point in search_results],
+            "latency_ms": request.duration * 1000,
+            "stages": request.stages(),
+        })
+
+    def answer(self, query, verbose_search=False, verbose_prompt=False):
+        start = time.perf_counter()
+        with trace("rag", log_path=self.trace_log_path, query=query) as request:
+            self.last_trace = request
+            query_embedding, cached = self.cache_lookup(query)
+            if cached is not None:
+                request.attrs["cache_hit"] = True
+                message, search_results = cached["answer"], cached["search_results"] or []
+            else:
+                search_results = self.retrieve(query, verbose_search=verbose_search)
+                prompt = self.build_prompt(query, search_results, verbose_prompt=verbose_prompt)
+                with span("generate"):
+                    message = llm(self.llm_client, prompt)
+        if cached is None:
+            self.cache_store(query, query_embedding, message, search_results, time.perf_counter() - start)
+        self.log_request(request, search_results)
+        return message
+
+    def answer_stream(self, query, verbose_search=False, verbose_prompt=False):
+        """
+        Streaming variant of `answer`: runs retrieval, then returns (search_results, tokens, trace)
+        where `tokens` is a generator over the answer. Sources can be shown before the first token.
+        `trace` is this request's `Trace` (finished once `tokens` is exhausted); unlike `last_trace`
+        it is safe to keep per user session when the engine is shared.
+        """
+        start = time.perf_counter()
+        request = Trace("rag_stream", log_path=self.trace_log_path, query=query)
+        self.last_trace = request
+        with request.activate():
+            query_embedding, cached = self.cache_lookup(query)
+            if cached is not None:
+                request.finish(cache_hit=True)
+                self.log_request(request, cached["search_results"] or [])
+                return cached["search_results"] or [], iter([cached["answer"]]), request
+            search_results = self.retrieve(query, verbose_search=verbose_search)
+            prompt = self.build_prompt(query, search_results, verbose_prompt=verbose_prompt)
+
+        def tokens():
+            parts = []
+            try:
+                with request.span("generate"):
+                    for token in llm_stream(self.llm_client, prompt, request_trace=request):
+                        parts.append(token)
+                        yield token
+            finally:
+                request.finish()
+                self.log_request(request, search_results)
+            self.cache_store(query, query_embedding, "".join(parts), search_results, time.perf_counter() - start)
+
+        return search_results, tokens(), request
+
+    async def aanswer(self, query, verbose_search=False, verbose_prompt=False):
+        """
+        Async variant of `answer`. Retrieval for the raw query starts immediately and runs
+        alongside query refinement; rewrite searches are then fanned out concurrently.
+        Returns (message, timings) where timings holds per-stage durations in seconds.
+        """
+        timings = {}
+        start = time.perf_counter()
+
+        async def timed(stage, awaitable):
+            stage_start = time.perf_counter()
+            result = await awaitable
+            timings[stage] = time.perf_counter() - stage_start
+            return result
+
+        with trace("arag", log_path=self.trace_log_path, query=query) as request:
+            self.last_trace = request
+            query_embedding, cached = await timed("cache_lookup", asyncio.to_thread(self.cache_lookup, query))
+            if cached is not None:
+                request.attrs["cache_hit"] = True
+                message, search_results = cached["answer"], cached["search_results"] or []
+            else:
+                original_task = None
+                if self.refinement_gate is not None:
+                    # the gate needs the raw query's results before deciding on refinement
+                    original_results, dense_score = await timed(
+                        "search_original", asyncio.to_thread(self.searcher.rrf_search_with_dense, query, 5))
+                    query_count = self.plan_refinement(query, original_results, dense_score)["query_count"]
+                else:
+                    original_task = asyncio.create_task(timed("search_original", self.searcher.arrf_search(query, 5)))
+                    query_count = 2
+                try:
+                    llm_queries = await timed("refine", arefine_query(query, self.async_llm_client, query_count, loader=self.loader, cache=self.llm_cache)) if query_count else []
+                    for q in llm_queries + [query]:
+                        print("Query: ", q)
+                    rewrite_results = await timed("search_rewrites", asyncio.gather(
+                        *(self.searcher.arrf_search(q, 5) for q in llm_queries)
+                    ))
+                    if original_task is not None:
+                        original_results = await original_task
+                finally:
+                    if original_task is not None and not original_task.done():
+                        original_task.cancel()  # refinement failed: don't leave the search running
+                timings["retrieval"] = time.perf_counter() - start
+                # same ordering as `answer`: rewrites first, original query last
+                search_results = unique_points(list(rewrite_results) + [original_results])
+                if verbose_search:
+                    print(len(search_results), "results in total search\n")
+                    print("Query search results:")
+                    print(*search_results, sep="\n\n")
+                prompt_start = time.perf_counter()
+                prompt = self.build_prompt(query, search_results, verbose_prompt=verbose_prompt)
+                timings["build_prompt"] = time.perf_counter() - prompt_start
+                with span("generate"):
+                    message = await timed("generate", allm(self.async_llm_client, prompt))
+            timings["total"] = time.perf_counter() - start
+        if cached is None:
+            self.cache_store(query, query_embedding, message, search_results, timings["total"])
+        self.log_request(request, search_results)
+        self.last_timings = timings
+        return message, timings
+
+
+@lru_cache(maxsize=8)
+def get_engine(secrets_path, collection, model_name="all-mpnet-base-v2", local_index_dir=None, backend="torch",
+               adaptive_refinement=False, answer_cache=False, llm_cache_path=None, context_token_budget=None):
+    """
+    Process-wide engine cache, one warmed engine per argument combination. Answer cache, LLM
+    cache and context budget are off unless requested (see `RagEngine`).
+    """
+    return RagEngine(secrets_path, collection, model_name=model_name, local_index_dir=local_index_dir, backend=backend,
+                     refinement_gate=adaptive_refinement, answer_cache=answer_cache, llm_cache_path=llm_cache_path,
+                     context_token_budget=context_token_budget).warmup()
+
+
+def rag(query, secrets_path, collection, verbose_search=False, verbose_prompt=False, **engine_options):
+    """`engine_options` go to `get_engine`, e.g. adaptive_refinement=True, answer_cache=True."""
+    engine = get_engine(secrets_path, collection, **engine_options)
+    return engine.answer(query, verbose_search=verbose_search, verbose_prompt=verbose_prompt)
+
+
+async def arag(query, secrets_path, collection, verbose_search=False, verbose_prompt=False, **engine_options):
+    """Async end-to-end RAG; returns (message, timings). Latency is close to max(refinement, search)."""
+    engine = get_engine(secrets_path, collection, **engine_options)
+    return await engine.aanswer(query, verbose_search=verbose_search, verbose_prompt=verbose_prompt)
@@ -0,0 +1,205 @@
+"""
+Row files for the `[level, title, page, text]` content and chunk rows.
+
+Besides the original indented JSON arrays (`_content.json`, `_chunked.json`), rows can be stored
+as JSONL (`_content.jsonl`, `_chunked.jsonl`): one compact JSON array per line plus a `<file>.idx`
+sidecar of little-endian uint64 line offsets (row count + 1 entries). Readers memory-map both,
+so opening a file parses nothing and `rows[i]` / `rows[a:b]` only decode the rows asked for.
+Writers append, and the index never gets ahead of the data. A writer opening a file with a
+missing or stale index (e.g. after an interrupted write) rebuilds it and drops a partially
+written last line; readers never modify files, they index such a file in memory. One writer
+per file at a time.
+
+`load_rows(path)` accepts either format, chosen by extension.
+"""
+import json
+import mmap
+import os
+import numpy as np
+
+ROW_FORMATS = ("json", "jsonl")
+_INDEX_DTYPE = np.dtype("<u8")
+
+
+def index_path(path):
+    return str(path) + ".idx"
+
+
+def sibling(path, suffix):
+    """`data/x_chunked.jsonl`, suffix `_meta.json` -> `data/x_meta.json` (either row format)."""
+    path = str(path)
+    for ext in (".jsonl", ".json"):
+        if path.endswith(ext):
+            path = path[:-len(ext)]
+            break
+    for kind in ("_chunked", "_content"):
+        if path.endswith(kind):
+            path = path[:-len(kind)]
+            break
+    return path + suffix
+
+
+def _line_offsets(path):
+    """Offsets of every complete line in `path`, plus the end of the last one."""
+    offsets = [0]
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # partially written row
+            offsets.append(offsets[-1] + len(line))
+    return np.array(offsets, dtype=_INDEX_DTYPE)
+
+
+def _index_is_current(path):
+    idx = index_path(path)
+    if not os.path.exists(idx) or os.path.getsize(idx) < _INDEX_DTYPE.itemsize:
+        return False
+    last = np.fromfile(idx, dtype=_INDEX_DTYPE, offset=os.path.getsize(idx) - _INDEX_DTYPE.itemsize)
+    return int(last[0]) == os.path.getsize(path)
+
+
+def _repair(path):
+    """Rebuilds a stale index and drops a partially written last line; returns the row count."""
+    if _index_is_current(path):
+        return os.path.getsize(index_path(path)) // _INDEX_DTYPE.itemsize - 1
+    offsets = _line_offsets(path)
+    if int(offsets[-1]) != os.path.getsize(path):
+        os.truncate(path, int(offsets[-1]))
+    tmp_path = index_path(path) + ".tmp"
+    offsets.tofile(tmp_path)
+    os.replace(tmp_path, index_path(path))
+    return len(offsets) - 1
+
+
+class RowWriter:
+    """Appends rows to a JSONL row file and its offsets index."""
+    def __init__(self, path, flush_every=1024):
+        self.path = str(path)
+        self.flush_every = flush_every
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.path):
+            self.count = _repair(self.path)
+        else:
+            open(self.path, "wb").close()
+            np.zeros(1, dtype=_INDEX_DTYPE).tofile(index_path(self.path))
+            self.count = 0
+        self.end = os.path.getsize(self.path)
+        self._pending = []  # offsets of rows whose data is not flushed yet
+        self._data = open(self.path, "ab")
+        self._index = open(index_path(self.path), "ab")
+
+    def append(self, row):
+        line = (json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        self._data.write(line)
+        self.end += len(line)
+        self._pending.append(self.end)
+        self.count += 1
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def write(self, rows):
+        for row in rows:
+            self.append(row)
+        return self
+
+    def flush(self):
+        # data first, so the index never points past it
+        self._data.flush()
+        if self._pending:
+            self._index.write(np.array(self._pending, dtype=_INDEX_DTYPE).tobytes())
+            self._pending = []
+        self._index.flush()
+
+    def close(self):
+        if not self._data.closed:
+            self.flush()
+            self._data.close()
+            self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RowReader:
+    """Lazy, random-access sequence over a JSONL row file."""
+    def __init__(self, path):
+        self.path = str(path)
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(self.path)
+        if _index_is_current(self.path):
+            self.offsets = np.memmap(index_path(self.path), dtype=_INDEX_DTYPE, mode="r")
+        else:
+            self.offsets = _line_offsets(self.path)  # not indexed (yet): scan, without touching the files
+        self._file = open(self.path, "rb")
+        size = int(self.offsets[-1])
+        self.data = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _row(self, index):
+        return json.loads(self.data[int(self.offsets[index]):int(self.offsets[index + 1])])
+
+    def _rows(self, start, stop):
+        """Rows start..stop-1 decoded in one call (a row never contains a raw newline)."""
+        if start >= stop:
+            return []
+        block = self.data[int(self.offsets[start]):int(self.offsets[stop])]
+        return json.loads(b"[" + block[:-1].replace(b"\n", b",") + b"]")
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return self._rows(start, stop)
+            return [self._row(i) for i in range(start, stop, step)]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+        return self._row(index)
+
+    def __iter__(self, block_size=1024):
+        for start in range(0, len(self), block_size):
+            yield from self._rows(start, min(start + block_size, len(self)))
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_rows(path):
+    """Rows of a `.jsonl` row file (lazy `RowReader`) or of a JSON array file (list)."""
+    path = str(path)
+    if path.endswith(".jsonl"):
+        return RowReader(path)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_rows(path, rows, row_format=None):
+    """Writes rows as a JSON array or a new JSONL row file; the format defaults to the extension."""
+    path = str(path)
+    row_format = row_format or ("jsonl" if path.endswith(".jsonl") else "json")
+    if row_format not in ROW_FORMATS:
+        raise ValueError(f"Unknown row format '{row_format}', expected one of {ROW_FORMATS}")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if row_format == "json":
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+        return
+    for stale in (path, index_path(path)):
+        if os.path.exists(stale):
+            os.remove(stale)
+    with RowWriter(path) as writer:
+        writer.write(rows)
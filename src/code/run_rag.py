@@ -6,9 +6,10 @@ calls rag_workflow.rag(query). It is intentionally minimal — adjust
 paths and collection names for your environment.
 """
 import argparse
+import asyncio
 import os
 
-from rag_workflow import rag
+from rag_workflow import arag, rag
 
 
 
@@ -18,12 +19,27 @@ def main():
     parser.add_argument("--collection", "-c", default="bfp-a3447q", help="Qdrant collection name to query")
     parser.add_argument("--model_cache", default="./src/code/models", help="SentenceTransformer cache folder")
     parser.add_argument("--model_name", default="all-mpnet-base-v2", help="SentenceTransformer model name")
+    parser.add_argument("--use_async", action="store_true", help="Run the async pipeline (arag) and print stage timings")
+    parser.add_argument("--adaptive_refinement", action="store_true", help="Skip query refinement when the raw query's results are confident")
+    parser.add_argument("--answer_cache", action="store_true", help="Reuse answers of semantically equal earlier queries")
+    parser.add_argument("--llm_cache", default=None, help="SQLite file caching LLM completions (refinement and answers)")
+    parser.add_argument("--context_token_budget", type=int, default=None, help="Token budget for retrieved context in the prompt")
     parser.add_argument("--secrets", default="../../.streamlit/secrets.toml", help="Path to streamlit secrets toml for OpenAI key")
     args = parser.parse_args()
 
+    engine_options = dict(adaptive_refinement=args.adaptive_refinement, answer_cache=args.answer_cache,
+                          llm_cache_path=args.llm_cache, context_token_budget=args.context_token_budget)
     # Run the pipeline
     print("Running RAG for query:", args.query)
-    resp = rag(args.query, args.secrets, args.collection, verbose_search=True, verbose_prompt=False)
+    if args.use_async:
+        resp, timings = asyncio.run(arag(args.query, args.secrets, args.collection, verbose_search=True, verbose_prompt=False,
+                                          **engine_options))
+        print("\n---- Stage timings [s] ----\n")
+        for stage, seconds in timings.items():
+            print(f"{stage:>16}: {seconds:.3f}")
+    else:
+        resp = rag(args.query, args.secrets, args.collection, verbose_search=True, verbose_prompt=False,
+                   **engine_options)
     print("\n---- RAG Response ----\n")
     print(resp)
 
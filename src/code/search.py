@@ -1,62 +1,187 @@
-from qdrant_client import QdrantClient, models
+from qdrant_client import AsyncQdrantClient, QdrantClient, models
+import asyncio
 import toml
-import json
+import time
+from src.code.search_history import get_history_writer
+from src.code.tracing import current_trace, span
+
+def unique_points(per_query):
+    """Flatten per-query results keeping the first occurrence of every point id."""
+    seen_ids = set()
+    unique = []
+    for points in per_query:
+        for point in points:
+            if point.id not in seen_ids: #avoid duplicates to be sent to LLM
+                seen_ids.add(point.id)
+                unique.append(point)
+    return unique
+
+def search_params(hnsw_ef=None, rescore=None, oversampling=None, exact=False):
+    """Qdrant `SearchParams` for dense queries, or None when everything is left at the defaults."""
+    quantization = None
+    if rescore is not None or oversampling is not None:
+        quantization = models.QuantizationSearchParams(rescore=rescore, oversampling=oversampling)
+    if hnsw_ef is None and quantization is None and not exact:
+        return None
+    return models.SearchParams(hnsw_ef=hnsw_ef, exact=exact, quantization=quantization)
 
 class Search:
-    def __init__(self, model, collection_name, model_name, history_storage, secrets_path):
+    def __init__(self, model, collection_name, model_name, history_storage, secrets_path, embedding_cache=None, client=None,
+                 hnsw_ef=None, rescore=None, oversampling=None, async_client=None):
+        """
+        `client` overrides the QdrantClient built from secrets, e.g. a local-mode client in benchmarks;
+        `async_client` does the same for the async methods. With only `client` given, async searches
+        run the sync client in a worker thread, so both paths always query the same backend.
+        `hnsw_ef` (search beam width) and, for quantized collections, `rescore` / `oversampling`
+        are sent with every dense query; None keeps Qdrant's defaults.
+        """
         config = toml.load(secrets_path)
         qdrant_url = getattr(config["qdrant"], "QDRANT_URL", "http://localhost:6333")
-        self.qd_client = QdrantClient(qdrant_url)
+        self.qdrant_url = qdrant_url
+        self.qd_client = client or QdrantClient(qdrant_url)
+        self._async_client = async_client
+        self._client_injected = client is not None
         self.model = model
         self.collection_name = collection_name
         self.model_name = model_name
         self.history_storage = history_storage
+        self.embedding_cache = embedding_cache
+        self.search_params = search_params(hnsw_ef, rescore, oversampling)
+
+    def encode(self, query):
+        """Encodes a query (or list of queries), going through the embedding cache when set."""
+        with span("embed", texts=1 if isinstance(query, str) else len(query)):
+            if self.embedding_cache is not None:
+                return self.embedding_cache.encode(self.model, query)
+            return self.model.encode(query)
 
     def search(self, query, limit=5):
-        results = self.qd_client.query_points(
-            collection_name=self.collection_name,
-            query=self.model.encode(query).tolist(),
-            limit=limit,
-            with_payload=True
-        )
+        vector = self.encode(query).tolist()
+        with span("qdrant_search") as s:
+            results = self.qd_client.query_points(
+                collection_name=self.collection_name,
+                query=vector,
+                limit=limit,
+                search_params=self.search_params,
+                with_payload=True
+            )
+            s.set(results=len(results.points))
         return results.points
 
     def search_with_history(self, query, limit=5):
-        results = self.qd_client.query_points(
-            collection_name=self.collection_name,
-            query=self.model.encode(query).tolist(),
-            limit=limit,
-            with_payload=True
-        )
+        """`search`, plus a history record (scores, latency, stage timings) written in the background."""
+        start = time.perf_counter()
+        points = self.search(query, limit)
+        request = current_trace()
         record = {}
         record['query'] = query
         record['ground_truth_points'] = []
         record['limit'] = limit
-        record['result_points_scores'] = [(point.id, point.score) for point in results.points]
-        with open(self.history_storage, "a+") as f:
-            f.write(json.dumps(record) + "\n")
-        return results.points
+        record['result_points_scores'] = [(point.id, point.score) for point in points]
+        record['latency_ms'] = (time.perf_counter() - start) * 1000
+        record['stages'] = request.stages() if request is not None else {}
+        get_history_writer(self.history_storage).write(record)
+        return points
 
-    def rrf_search(self, query: str, limit: int = 5):
-        results = self.qd_client.query_points(
-            collection_name=self.collection_name,
-            prefetch=[
-                models.Prefetch(
-                    query=self.model.encode(query).tolist(),
-                    using=self.model_name,
-                    limit=(5 * limit),
-                ),
-                models.Prefetch(
-                    query=models.Document(
-                        text=query,
-                        model="Qdrant/bm25",
-                    ),
-                    using="bm25",
-                    limit=(5 * limit),
+    def _rrf_prefetch(self, query: str, vector: list, limit: int):
+        return [
+            models.Prefetch(
+                query=vector,
+                using=self.model_name,
+                limit=(5 * limit),
+                params=self.search_params,
+            ),
+            models.Prefetch(
+                query=models.Document(
+                    text=query,
+                    model="Qdrant/bm25",
                 ),
-            ],
-            query=models.FusionQuery(fusion=models.Fusion.RRF),
-            limit=limit,
-            with_payload=True
-        )
+                using="bm25",
+                limit=(5 * limit),
+            ),
+        ]
+
+    def rrf_search(self, query: str, limit: int = 5):
+        prefetch = self._rrf_prefetch(query, self.encode(query).tolist(), limit)
+        with span("qdrant_rrf_search") as s:
+            results = self.qd_client.query_points(
+                collection_name=self.collection_name,
+                prefetch=prefetch,
+                query=models.FusionQuery(fusion=models.Fusion.RRF),
+                limit=limit,
+                with_payload=True
+            )
+            s.set(results=len(results.points))
+        return results.points
+
+    def rrf_search_with_dense(self, query: str, limit: int = 5):
+        """
+        `rrf_search` plus the best dense (cosine) score for the query, from one encode and one
+        batched Qdrant request. Returns (points, dense_top_score); the score is None without hits.
+        """
+        vector = self.encode(query).tolist()
+        requests = [
+            models.QueryRequest(
+                prefetch=self._rrf_prefetch(query, vector, limit),
+                query=models.FusionQuery(fusion=models.Fusion.RRF),
+                limit=limit,
+                with_payload=True
+            ),
+            models.QueryRequest(query=vector, using=self.model_name, limit=1, params=self.search_params),
+        ]
+        with span("qdrant_rrf_search", dense=True) as s:
+            fused, dense = self.qd_client.query_batch_points(collection_name=self.collection_name, requests=requests)
+            s.set(results=len(fused.points))
+        return fused.points, (dense.points[0].score if dense.points else None)
+
+    @property
+    def async_client(self):
+        """AsyncQdrantClient created on first use, so sync-only callers never open it."""
+        if self._async_client is None:
+            self._async_client = AsyncQdrantClient(self.qdrant_url)
+        return self._async_client
+
+    async def arrf_search(self, query: str, limit: int = 5):
+        """Async variant of `rrf_search`; encoding runs in a worker thread to keep the loop free."""
+        if self._async_client is None and self._client_injected:
+            return await asyncio.to_thread(self.rrf_search, query, limit)
+        vector = await asyncio.to_thread(self.encode, query)
+        with span("qdrant_rrf_search") as s:
+            results = await self.async_client.query_points(
+                collection_name=self.collection_name,
+                prefetch=self._rrf_prefetch(query, vector.tolist(), limit),
+                query=models.FusionQuery(fusion=models.Fusion.RRF),
+                limit=limit,
+                with_payload=True
+            )
+            s.set(results=len(results.points))
         return results.points
+
+    def rrf_search_batch(self, queries: list[str], limit: int = 5):
+        """
+        Hybrid RRF search for several queries at once.
+        Dense vectors are encoded in a single batch and all queries go to Qdrant in one request.
+        Returns (per_query_points, unique_points) where unique_points keeps the first
+        occurrence of every point id, in query order.
+        """
+        if not queries:
+            return [], []
+        vectors = self.encode(queries)
+        requests = [
+            models.QueryRequest(
+                prefetch=self._rrf_prefetch(query, vector.tolist(), limit),
+                query=models.FusionQuery(fusion=models.Fusion.RRF),
+                limit=limit,
+                with_payload=True
+            )
+            for query, vector in zip(queries, vectors)
+        ]
+        with span("qdrant_batch_search", queries=len(queries)) as s:
+            responses = self.qd_client.query_batch_points(
+                collection_name=self.collection_name,
+                requests=requests
+            )
+            per_query = [response.points for response in responses]
+            unique = unique_points(per_query)
+            s.set(results=len(unique))
+        return per_query, unique
@@ -0,0 +1,290 @@
+"""
+Search history logging and analytics.
+
+`HistoryWriter` takes records off the request path: `write` only enqueues, a daemon thread
+appends them in batches. The JSONL file is rotated by size and/or time period into
+`<name>.<YYYYmmdd-HHMMSS>.jsonl` siblings, and every append/rotation holds an exclusive
+`flock` on `<path>.lock`, so several processes (e.g. Streamlit workers) can share one file.
+
+The CLI streams one or more history files (rotated siblings included) and prints top queries,
+score and latency distributions, stage timings and the slowest queries:
+
+    python -m src.code.search_history data/search_history.jsonl --top 20
+"""
+import argparse
+import atexit
+import glob
+import heapq
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import Counter
+try:
+    import fcntl
+except ImportError:  # not available on Windows; appends are then only safe within one process
+    fcntl = None
+
+_STOP = object()
+
+
+def rotated_files(path):
+    """Rotated siblings of `path`, oldest first."""
+    stem, ext = os.path.splitext(path)
+    return sorted(glob.glob(f"{glob.escape(stem)}.*{ext}"))
+
+
+class HistoryWriter:
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, rotate_interval=None, backups=10,
+                 batch_size=256, flush_interval=1.0, queue_size=10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval  # seconds, e.g. 86400 for daily files
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock_path = path + ".lock"
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self._first_timestamp = None  # (inode, timestamp of the first record in the current file)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, record):
+        """Enqueues a record without blocking; it is dropped (and counted) when the queue is full."""
+        record.setdefault("timestamp", time.time())
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Blocks until every record enqueued so far is on disk."""
+        self.queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not _STOP and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _STOP
+            records = batch[:-1] if stop else batch
+            try:
+                if records:
+                    self._append(records)
+            except Exception as e:
+                print(f"Search history write failed ({len(records)} records lost): {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def _append(self, records):
+        data = "".join(json.dumps(record, default=str) + "\n" for record in records).encode("utf-8")
+        with open(self.lock_path, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._maybe_rotate(records[0]["timestamp"])
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        self.written += len(records)
+
+    def _file_start(self, stat):
+        """Timestamp of the first record of the current file (read once per file)."""
+        if self._first_timestamp is None or self._first_timestamp[0] != stat.st_ino:
+            with open(self.path, "r", encoding="utf-8") as f:
+                try:
+                    started = json.loads(f.readline()).get("timestamp")
+                except (json.JSONDecodeError, AttributeError):
+                    started = None
+            self._first_timestamp = (stat.st_ino, started or stat.st_mtime)
+        return self._first_timestamp[1]
+
+    def _maybe_rotate(self, now):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if stat.st_size == 0:
+            return
+        rotate = self.max_bytes and stat.st_size >= self.max_bytes
+        if not rotate and self.rotate_interval:
+            rotate = int(self._file_start(stat) // self.rotate_interval) != int(now // self.rotate_interval)
+        if not rotate:
+            return
+        stem, ext = os.path.splitext(self.path)
+        target = f"{stem}.{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}{ext}"
+        suffix = 1
+        while os.path.exists(target):
+            target = f"{stem}.{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{suffix}{ext}"
+            suffix += 1
+        os.replace(self.path, target)
+        self.rotations += 1
+        if self.backups:
+            for old in rotated_files(self.path)[:-self.backups]:
+                os.remove(old)
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "written": self.written, "dropped": self.dropped, "rotations": self.rotations}
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+def get_history_writer(path, **kwargs):
+    """One shared writer (and thread) per history file in this process."""
+    key = os.path.abspath(path)
+    with _writers_lock:
+        if key not in _writers:
+            _writers[key] = HistoryWriter(path, **kwargs)
+        return _writers[key]
+
+
+def iter_records(paths):
+    """Streams records from history files; a directory or base path also yields its rotated siblings."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*.jsonl")))
+            continue
+        files += [p for p in rotated_files(path) if p not in files]
+        if os.path.exists(path) and path not in files:
+            files.append(path)
+    for file_path in files:
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # partially written line
+
+
+class Reservoir:
+    """Fixed-size uniform sample, for quantiles over streams of any length."""
+    def __init__(self, size=10000, seed=0):
+        self.size = size
+        self.values = []
+        self.seen = 0
+        self.rng = random.Random(seed)
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            slot = self.rng.randrange(self.seen)
+            if slot < self.size:
+                self.values[slot] = value
+
+    def quantiles(self, qs=(0.5, 0.9, 0.95, 0.99)):
+        if not self.values:
+            return {}
+        ordered = sorted(self.values)
+        return {f"p{int(q * 100)}": ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in qs}
+
+
+def aggregate(records, top=10, max_tracked_queries=100000):
+    """Single pass over `records`; memory is bounded by the reservoirs and the query counter cap."""
+    queries = Counter()
+    top_scores, latencies = Reservoir(), Reservoir()
+    stages = {}
+    slowest = []
+    total = 0
+    empty = 0
+    refinement = Counter()
+    for record in records:
+        total += 1
+        query = (record.get("query") or "").strip().lower()
+        queries[query] += 1
+        if len(queries) > max_tracked_queries:
+            # keep the heavy hitters, forget the long tail
+            queries = Counter(dict(queries.most_common(max_tracked_queries // 2)))
+        scores = [score for _, score in record.get("result_points_scores") or []]
+        if scores:
+            top_scores.add(max(scores))
+        else:
+            empty += 1
+        latency = record.get("latency_ms")
+        if latency is not None:
+            latencies.add(latency)
+            entry = (latency, total, record.get("query"))  # record number breaks ties, queries are never compared
+            if len(slowest) < top:
+                heapq.heappush(slowest, entry)
+            elif entry > slowest[0]:
+                heapq.heapreplace(slowest, entry)
+        plan = record.get("refinement")
+        if plan:
+            refinement[plan["decision"]] += 1
+        for stage, seconds in (record.get("stages") or {}).items():
+            count, total_seconds = stages.get(stage, (0, 0.0))
+            stages[stage] = (count + 1, total_seconds + seconds)
+    return {
+        "records": total,
+        "no_results": empty,
+        "top_queries": queries.most_common(top),
+        "top_score": top_scores.quantiles(),
+        "latency_ms": latencies.quantiles(),
+        "stage_mean_ms": {stage: 1000 * seconds / count for stage, (count, seconds) in stages.items()},
+        "slowest": [(latency, query) for latency, _, query in sorted(slowest, reverse=True)],
+        "refinement": dict(refinement),
+        "refinement_skip_rate": refinement["skip"] / sum(refinement.values()) if refinement else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate search history JSONL files (streamed)")
+    parser.add_argument("paths", nargs="+", help="History files or directories; rotated siblings are included")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="Print the aggregate as JSON")
+    args = parser.parse_args()
+    summary = aggregate(iter_records(args.paths), top=args.top)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"{summary['records']} records, {summary['no_results']} without results")
+    print("\nTop queries:")
+    for query, count in summary["top_queries"]:
+        print(f"{count:8d}  {query}")
+    print("\nTop-1 score:", ", ".join(f"{k}={v:.3f}" for k, v in summary["top_score"].items()) or "-")
+    print("Latency ms: ", ", ".join(f"{k}={v:.1f}" for k, v in summary["latency_ms"].items()) or "-")
+    if summary["refinement"]:
+        print(f"Refinement: skipped {summary['refinement_skip_rate']:.1%} of gated requests (",
+              ", ".join(f"{k}={v}" for k, v in sorted(summary["refinement"].items())), ")", sep="")
+    if summary["stage_mean_ms"]:
+        print("\nMean stage time:")
+        for stage, ms in sorted(summary["stage_mean_ms"].items(), key=lambda item: -item[1]):
+            print(f"{ms:10.1f} ms  {stage}")
+    if summary["slowest"]:
+        print("\nSlowest queries:")
+        for latency, query in summary["slowest"]:
+            print(f"{latency:10.1f} ms  {query}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Streaming ingestion of one manual: PDF pages -> TOC chapters -> chunks -> embedded point batches -> Qdrant,
+without the `_content.json` / `_chunked.json` round trip.
+
+Every stage is a generator and the stages are connected by bounded queues, so memory stays flat
+regardless of the manual's size. When embedding or upserting falls behind, conversion blocks
+instead of buffering. Points are upserted batch by batch and are searchable while later pages
+are still being converted. Point ids and the manifest are the same as in the file-based flow,
+so the two can be mixed (incremental re-runs, stale point deletion).
+
+    python -m src.code.stream_ingest data/manual.pdf --collection manuals
+"""
+import argparse
+import os
+import queue
+import threading
+import time
+from qdrant_client import QdrantClient
+from src.code.chunking import TextChunker
+from src.code.embedding import EmbeddingUploader, manual_source, manual_title
+from src.code.pdf_to_md import PDFToMarkdown
+
+_DONE = object()
+
+
+def prefetch(iterable, size):
+    """
+    Runs `iterable` in a background thread at most `size` items ahead of the consumer, so
+    producer and consumer overlap. Exceptions are re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(e)
+
+    worker = threading.Thread(target=producer, name="prefetch", daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()  # consumer stopped early: let the producer exit
+
+
+def stream_pdf(pdf_path, chunker, uploader, qdrant_url="http://localhost:6333", client=None, token_limit=300,
+               workers=1, chapter_queue_size=8, image_path="data/images", margins=(50, 75), incremental=True,
+               manifest_path=None, **storage_options):
+    """
+    Ingests one PDF through the streaming pipeline; returns the number of points upserted.
+    The manual is identified by its file stem (`manual_source`), as in the file-based flow.
+    """
+    started = time.perf_counter()
+    converter = PDFToMarkdown(pdf_path, image_path=image_path, margins=margins)
+    converter.save_metadata()
+    title = manual_title(converter.doc.metadata)  # display only; ids and manifest follow the file
+    chapters = prefetch(converter.iter_chapters(workers=workers), chapter_queue_size)
+    rows = chunker.iter_chunks(chapters, token_limit=token_limit)
+    manifest_path = manifest_path or uploader.manifest_path(os.path.splitext(pdf_path)[0] + "_chunked.json")
+    uploaded = uploader.stream_hybrid_embeddings(rows, title, manual_source(pdf_path), manifest_path, qdrant_url=qdrant_url,
+                                                 incremental=incremental, client=client, **storage_options)
+    print(f"Streamed {pdf_path} into '{uploader.collection_name}' in {time.perf_counter() - started:.1f}s")
+    return uploaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert, chunk and embed PDFs into Qdrant as a streaming pipeline")
+    parser.add_argument("paths", nargs="+", help="PDF files")
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--model_name", default="all-mpnet-base-v2")
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx", "onnx-int8"])
+    parser.add_argument("--qdrant_url", default=os.environ.get("QDRANT_URL", "http://localhost:6333"))
+    parser.add_argument("--workers", type=int, default=1, help="Processes converting pages ahead of the pipeline")
+    parser.add_argument("--token_limit", type=int, default=300)
+    parser.add_argument("--embedding_cache_dir", default=None)
+    parser.add_argument("--encode_batch_size", type=int, default=32)
+    parser.add_argument("--upsert_batch_size", type=int, default=256)
+    parser.add_argument("--quantization", default=None, choices=["int8", "binary"])
+    parser.add_argument("--on_disk", action="store_true")
+    parser.add_argument("--full", action="store_true", help="Re-embed every chunk instead of only new/changed ones")
+    args = parser.parse_args()
+    chunker = TextChunker("sentence-transformers/" + args.model_name)
+    uploader = EmbeddingUploader(
+        model_name=args.model_name, collection_name=args.collection, backend=args.backend,
+        encode_batch_size=args.encode_batch_size, upsert_batch_size=args.upsert_batch_size,
+        embedding_cache_dir=args.embedding_cache_dir)
+    client = QdrantClient(args.qdrant_url)
+    for path in args.paths:
+        stream_pdf(path, chunker, uploader, client=client, token_limit=args.token_limit, workers=args.workers,
+                   incremental=not args.full, quantization=args.quantization, on_disk=args.on_disk)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Per-stage tracing for the RAG workflow.
+
+`span(stage, **attrs)` times a block and records it in Prometheus histograms
+(`rag_stage_duration_seconds`, `rag_stage_tokens`, `rag_stage_results`, labelled by stage).
+Inside a request `trace(...)` the span is also attached to that request, so one answer can
+be broken down into model load, refinement, embedding, Qdrant search, prompt building and
+generation. Finished traces are kept in memory (`recent_traces`) and, when `log_path` is set,
+appended to a JSONL file.
+
+    with trace("rag", log_path="data/traces.jsonl", query=query):
+        with span("qdrant_search") as s:
+            points = ...
+            s.set(results=len(points))
+
+Expose the histograms with `start_metrics_server(port)` or `render_metrics()`.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from prometheus_client import REGISTRY, Histogram, generate_latest, start_http_server
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_duration_seconds", "Duration of RAG workflow stages", ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+STAGE_TOKENS = Histogram(
+    "rag_stage_tokens", "LLM tokens per call", ["stage", "kind"],
+    buckets=(16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384),
+)
+STAGE_RESULTS = Histogram(
+    "rag_stage_results", "Items returned per stage (search points, rewrites, ...)", ["stage"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+TOKEN_KINDS = ("prompt_tokens", "completion_tokens")
+
+_current = contextvars.ContextVar("rag_trace", default=None)
+_recent = deque(maxlen=100)
+_log_lock = threading.Lock()
+
+
+class Span:
+    def __init__(self, stage, trace=None, **attrs):
+        self.stage = stage
+        self.trace = trace
+        self.attrs = attrs
+        self.start = None
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        STAGE_SECONDS.labels(stage=self.stage).observe(self.duration)
+        for kind in TOKEN_KINDS:
+            # cache hits carry the original call's usage for the trace but spent no tokens
+            if self.attrs.get(kind) is not None and not self.attrs.get("cached"):
+                STAGE_TOKENS.labels(stage=self.stage, kind=kind.split("_")[0]).observe(self.attrs[kind])
+        if self.attrs.get("results") is not None:
+            STAGE_RESULTS.labels(stage=self.stage).observe(self.attrs["results"])
+        if self.trace is not None:
+            self.trace.spans.append(self)
+        return False
+
+    def to_dict(self):
+        return {"stage": self.stage, "seconds": self.duration, **self.attrs}
+
+
+class Trace:
+    """Spans of one request. Use `activate()` to make it current and `finish()` once done."""
+    def __init__(self, name, log_path=None, **attrs):
+        self.name = name
+        self.log_path = log_path
+        self.attrs = attrs
+        self.spans = []
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def span(self, stage, **attrs):
+        return Span(stage, self, **attrs)
+
+    def activate(self):
+        """Context manager making this the current trace, e.g. for spans emitted by a generator."""
+        return _Activation(self)
+
+    def stages(self):
+        """Total seconds per stage, in first-seen order."""
+        totals = {}
+        for span in self.spans:
+            totals[span.stage] = totals.get(span.stage, 0.0) + span.duration
+        return totals
+
+    def finish(self, **attrs):
+        if self.duration is not None:
+            return self
+        self.attrs.update(attrs)
+        self.duration = time.perf_counter() - self.start
+        STAGE_SECONDS.labels(stage=self.name).observe(self.duration)
+        _recent.append(self)
+        if self.log_path:
+            self._log()
+        return self
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "timestamp": self.started,
+            "seconds": self.duration,
+            **self.attrs,
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+    def _log(self):
+        os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+        with _log_lock, open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(self.to_dict(), default=str) + "\n")
+
+
+class _Activation:
+    def __init__(self, trace):
+        self.trace = trace
+        self.token = None
+
+    def __enter__(self):
+        self.token = _current.set(self.trace)
+        return self.trace
+
+    def __exit__(self, *exc):
+        _current.reset(self.token)
+        return False
+
+
+class trace:
+    """Context manager starting a request trace; spans opened inside it (in any function) attach to it."""
+    def __init__(self, name, log_path=None, **attrs):
+        self.trace = Trace(name, log_path, **attrs)
+        self._activation = self.trace.activate()
+
+    def __enter__(self):
+        return self._activation.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        self._activation.__exit__(exc_type, exc, tb)
+        self.trace.finish(**({"error": exc_type.__name__} if exc_type else {}))
+        return False
+
+
+def span(stage, **attrs):
+    """Times a stage; attached to the current request trace when there is one."""
+    return Span(stage, _current.get(), **attrs)
+
+
+def current_trace():
+    return _current.get()
+
+
+def recent_traces(limit=None):
+    traces = list(_recent)
+    return traces[-limit:] if limit else traces
+
+
+def llm_usage(response):
+    """Token counts from an OpenAI response (or final stream chunk) as span attrs."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return {}
+    return {kind: getattr(usage, kind, None) for kind in TOKEN_KINDS}
+
+
+def _histogram_quantile(q, buckets):
+    """Prometheus-style `histogram_quantile` over cumulative (upper_bound, count) buckets."""
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0.0
+    for upper, count in buckets:
+        if count >= rank:
+            if upper == float("inf"):
+                return lower
+            return lower + (upper - lower) * ((rank - below) / (count - below) if count > below else 0.0)
+        lower, below = upper, count
+    return lower
+
+
+def stage_summary():
+    """Per-stage call count, mean and estimated p50/p95 latency (seconds) since process start."""
+    stages = {}
+    for metric in STAGE_SECONDS.collect():
+        for sample in metric.samples:
+            stage = sample.labels["stage"]
+            entry = stages.setdefault(stage, {"buckets": []})
+            if sample.name.endswith("_bucket"):
+                entry["buckets"].append((float(sample.labels["le"]), sample.value))
+            elif sample.name.endswith("_count"):
+                entry["count"] = int(sample.value)
+            elif sample.name.endswith("_sum"):
+                entry["sum"] = sample.value
+    summary = {}
+    for stage, entry in stages.items():
+        count = entry.get("count", 0)
+        if not count:
+            continue
+        buckets = sorted(entry["buckets"])
+        summary[stage] = {
+            "count": count,
+            "mean": entry.get("sum", 0.0) / count,
+            "p50": _histogram_quantile(0.50, buckets),
+            "p95": _histogram_quantile(0.95, buckets),
+        }
+    return summary
+
+
+def render_metrics():
+    """Metrics in the Prometheus text exposition format."""
+    return generate_latest(REGISTRY).decode("utf-8")
+
+
+def start_metrics_server(port=9464, addr="0.0.0.0"):
+    """Serves /metrics for Prometheus scraping from a daemon thread."""
+    return start_http_server(port, addr=addr)
@@ -1,6 +1,7 @@
 import streamlit as st
-from src.code import rag_workflow
+from src.code import tracing
 from utils.auth import authenticate
+from utils.engine_loader import EngineLoader
 
 authenticate()
 st.set_page_config(page_title="RAG Chat", layout="wide")
@@ -25,14 +26,51 @@ if "messages" not in st.session_state:
         {"role": "system", "content": "You are a helpful assistant with access to product manuals and support docs."}
     ]
 
+@st.cache_resource(show_spinner=False)
+def engine_loader(secrets_path: str, collection: str):
+    # Shared across all sessions: the model and clients are created once per process,
+    # in a background thread (see EngineLoader), so this never blocks the page.
+    return EngineLoader(secrets_path, collection)
+
+def render_readiness(loader):
+    if loader.error is not None:
+        st.error(f"Backend failed to load: {loader.error}")
+    elif loader.ready:
+        st.success(f"Backend ready (loaded in {loader.load_seconds:.1f} s)")
+    else:
+        st.info(f"Loading backend... {loader.elapsed:.0f} s")
+
+@st.fragment(run_every=1)
+def poll_readiness(loader):
+    render_readiness(loader)
+    if loader.ready:
+        st.rerun()  # full rerun shows the final state and stops polling
+
+def render_sources(search_results):
+    with st.expander(f"Sources ({len(search_results)})"):
+        for point in search_results:
+            payload = point.payload
+            st.markdown(f"**{payload['manual']}** — {payload['main_chapter']} › {payload['chapter']} (page {payload['page']})")
+
 def send_query(user_text: str):
+    """Runs retrieval, shows the sources, then streams the answer into the current chat message."""
     st.session_state.messages.append({"role": "user", "content": user_text})
     # Call the project RAG implementation `rag_workflow.rag(...)`.
     # The `secrets_path` and `collection` are stored in session state (set via sidebar).
     secrets_path = st.session_state.get("secrets_path", "./secrets.toml")
     collection = st.session_state.get("collection", "my_qdrant_collection")
     try:
-        resp = rag_workflow.rag(user_text, secrets_path=secrets_path, collection=collection)
+        loader = engine_loader(secrets_path, collection).start()
+        if not loader.ready:
+            with st.spinner("Waiting for the backend to finish loading..."):
+                loader.wait()
+        engine = loader.wait()
+        with st.spinner("Searching the manuals..."):
+            search_results, tokens, request_trace = engine.answer_stream(user_text)
+        render_sources(search_results)
+        resp = st.write_stream(tokens)
+        # this request's own trace: the engine (and its `last_trace`) is shared by every session
+        st.session_state["last_trace"] = request_trace
         st.session_state.messages.append({"role": "assistant", "content": resp})
         return resp
     except Exception as e:
@@ -51,6 +89,31 @@ def send_query(user_text: str):
         st.text_area("RAG traceback (for debugging)", value=tb, height=200)
         return failure_msg
 
+def render_latency_panel():
+    """Stage breakdown of this session's last answer and per-stage latency since the backend started."""
+    st.subheader("Latency")
+    last_trace = st.session_state.get("last_trace")
+    if last_trace is not None and last_trace.duration is not None:
+        cache_note = " (answer cache hit)" if last_trace.attrs.get("cache_hit") else ""
+        st.caption(f"Last answer: {last_trace.duration:.2f} s{cache_note}")
+        st.dataframe(
+            [{"stage": stage, "ms": round(seconds * 1000, 1)} for stage, seconds in last_trace.stages().items()],
+            hide_index=True
+        )
+    summary = tracing.stage_summary()
+    if not summary:
+        st.caption("No requests yet.")
+        return
+    st.caption("All requests")
+    st.dataframe(
+        [
+            {"stage": stage, "count": values["count"], "mean ms": round(values["mean"] * 1000, 1),
+             "p95 ms": round(values["p95"] * 1000, 1)}
+            for stage, values in summary.items()
+        ],
+        hide_index=True
+    )
+
 # Chat UI
 chat_col, info_col = st.columns([3, 1])
 
@@ -65,8 +128,17 @@ with chat_col:
     if prompt:
         with st.chat_message("user"):
             st.markdown(prompt)
-        # send and display assistant reply
-        reply = send_query(prompt)
+        # send and stream assistant reply
         with st.chat_message("assistant"):
-            st.markdown(reply)
+            send_query(prompt)
+
+with info_col:
+    render_latency_panel()
 
+# Start loading the backend only after the page has been laid out
+loader = engine_loader(secrets_path, collection).start()
+with st.sidebar:
+    if loader.ready:
+        render_readiness(loader)
+    else:
+        poll_readiness(loader)
@@ -0,0 +1,56 @@
+import threading
+import time
+
+# the chat app opts in to the answer cache, persistent LLM cache and context budget
+ENGINE_OPTIONS = {"answer_cache": True, "llm_cache_path": "./data/llm_cache.sqlite", "context_token_budget": 3000}
+
+class EngineLoader:
+    """
+    Builds the RAG engine in a background thread so the page renders before the heavy
+    imports (torch, sentence-transformers, qdrant_client, openai) and the model load finish.
+    Keep one instance per process (`st.cache_resource`); `wait()` blocks until the engine is ready.
+    """
+    def __init__(self, secrets_path, collection):
+        self.secrets_path = secrets_path
+        self.collection = collection
+        self.engine = None
+        self.error = None
+        self.started_at = None
+        self.load_seconds = None
+        self._ready = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self.started_at = time.perf_counter()
+                self._thread = threading.Thread(target=self._load, name="rag-engine-warmup", daemon=True)
+                self._thread.start()
+        return self
+
+    def _load(self):
+        try:
+            from src.code import rag_workflow  # heavy imports happen here, off the script thread
+            self.engine = rag_workflow.get_engine(self.secrets_path, self.collection, **ENGINE_OPTIONS)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.load_seconds = time.perf_counter() - self.started_at
+            self._ready.set()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started_at if self.started_at else 0.0
+
+    def wait(self, timeout=None):
+        self.start()
+        if not self._ready.wait(timeout):
+            raise TimeoutError(f"RAG backend not ready after {timeout}s")
+        if self.error is not None:
+            raise self.error
+        return self.engine